@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+# Measures buildploy's own overhead on generated source repositories.
+#
+# Three scenarios are run end to end: a cold run with an empty work prefix,
+# a no-op run with nothing changed upstream, and a run after a single file
+# has been changed in every branch. Per-phase timings are collected via
+# --timings and compared against a stored baseline.
+
+import json
+import optparse
+import os
+import os.path
+import random
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from buildploy import run, run_in_dir, rm_rf
+
+bench_root = os.path.realpath(os.path.dirname(__file__))
+build_script = os.path.join(bench_root, '../buildploy.py')
+
+# submodules are added from local paths
+git_env = dict(os.environ)
+git_env.update({
+    'GIT_CONFIG_COUNT': '1',
+    'GIT_CONFIG_KEY_0': 'protocol.file.allow',
+    'GIT_CONFIG_VALUE_0': 'always',
+})
+
+scenarios = ['cold', 'noop', 'change']
+
+def write_file(path, size, rand):
+    dir = os.path.dirname(path)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    # text content compresses similarly to real sources
+    line = ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz ') for i in range(79)) + "\n"
+    with open(path, 'w') as f:
+        f.write((line * (size // len(line) + 1))[:size])
+
+def git_commit_all(dir, message):
+    run_in_dir(dir, ['git', 'add', '-A'], env=git_env)
+    run_in_dir(dir, ['git', 'commit', '-q', '--allow-empty', '-m', message], env=git_env)
+
+def generate(bench_dir, options):
+    '''Creates source repository, its submodules and an empty deployment
+    repository under bench_dir.
+    '''
+    
+    rand = random.Random(42)
+    run(['git', 'init', '-q', '--bare', os.path.join(bench_dir, 'src.git')])
+    run(['git', 'init', '-q', '--bare', os.path.join(bench_dir, 'deploy.git')])
+    work = os.path.join(bench_dir, 'src')
+    run(['git', 'clone', '-q', os.path.join(bench_dir, 'src.git'), work])
+    
+    paths = []
+    for i in range(options.files):
+        path = 'dir%03d/file%05d.txt' % (i % 100, i)
+        write_file(os.path.join(work, path), options.file_size, rand)
+        paths.append(path)
+    git_commit_all(work, 'Initial commit')
+    
+    for i in range(options.submodules):
+        sub_dir = os.path.join(bench_dir, 'sub%02d' % i)
+        run(['git', 'init', '-q', sub_dir])
+        for j in range(options.files // 10 + 1):
+            write_file(os.path.join(sub_dir, 'file%05d.txt' % j), options.file_size, rand)
+        git_commit_all(sub_dir, 'Submodule commit')
+        run_in_dir(work, ['git', 'submodule', '--quiet', 'add', sub_dir, 'vendor/sub%02d' % i],
+            env=git_env)
+    if options.submodules:
+        git_commit_all(work, 'Add submodules')
+    
+    for i in range(options.history):
+        for path in rand.sample(paths, min(3, len(paths))):
+            write_file(os.path.join(work, path), options.file_size, rand)
+        git_commit_all(work, 'History commit %d' % i)
+    
+    branches = ['master']
+    for i in range(1, options.branches):
+        branch = 'branch%02d' % i
+        run_in_dir(work, ['git', 'checkout', '-q', '-b', branch, 'master'])
+        write_file(os.path.join(work, 'branch.txt'), options.file_size, rand)
+        git_commit_all(work, 'Branch %s' % branch)
+        branches.append(branch)
+    run_in_dir(work, ['git', 'checkout', '-q', 'master'])
+    run_in_dir(work, ['git', 'push', '-q', 'origin'] + branches)
+    return branches
+
+def change_one_file(bench_dir, branches):
+    work = os.path.join(bench_dir, 'src')
+    for branch in branches:
+        run_in_dir(work, ['git', 'checkout', '-q', branch])
+        with open(os.path.join(work, 'dir000/file00000.txt'), 'a') as f:
+            f.write('changed\n')
+        git_commit_all(work, 'Change one file')
+    run_in_dir(work, ['git', 'checkout', '-q', 'master'])
+    run_in_dir(work, ['git', 'push', '-q', 'origin'] + branches)
+
+def run_buildploy(bench_dir, branches, options, scenario):
+    config_path = os.path.join(bench_dir, 'config.json')
+    config = {
+        'src_repo': os.path.join(bench_dir, 'src.git'),
+        'deploy_repo': os.path.join(bench_dir, 'deploy.git'),
+        'work_prefix': os.path.join(bench_dir, 'work'),
+        'build_cmd': options.build_cmd,
+        'branches': branches,
+    }
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+    timings_path = os.path.join(bench_dir, 'timings-%s.json' % scenario)
+    args = [sys.executable, build_script, config_path, '--timings', timings_path]
+    args += options.buildploy_args.split()
+    with open(os.path.join(bench_dir, 'output-%s' % scenario), 'w') as f:
+        run(args, env=git_env, stdout=f)
+    with open(timings_path) as f:
+        return json.load(f)
+
+def summarize(report):
+    result = {
+        'seconds': report['seconds'],
+        'subprocesses': report['subprocesses'],
+        'phases': {},
+    }
+    for phase, total in report['totals'].items():
+        result['phases'][phase] = {
+            'seconds': total['seconds'],
+            'subprocesses': total['subprocesses'],
+        }
+    return result
+
+def compare(results, baseline, options):
+    '''Returns a list of regressions of results relative to baseline.
+    
+    Subprocess counts are deterministic and any increase is reported;
+    times are compared with the configured relative tolerance, ignoring
+    differences below the minimum delta.
+    '''
+    
+    regressions = []
+    
+    def check(name, current, previous):
+        if current['subprocesses'] > previous['subprocesses']:
+            regressions.append('%s: %d subprocesses, baseline %d' % (
+                name, current['subprocesses'], previous['subprocesses']))
+        delta = current['seconds'] - previous['seconds']
+        if delta > options.min_delta and delta > previous['seconds'] * options.tolerance:
+            regressions.append('%s: %.2fs, baseline %.2fs' % (
+                name, current['seconds'], previous['seconds']))
+    
+    for scenario in scenarios:
+        if scenario not in baseline['results']:
+            continue
+        current = results[scenario]
+        previous = baseline['results'][scenario]
+        check(scenario, current, previous)
+        for phase in sorted(current['phases']):
+            if phase in previous['phases']:
+                check('%s/%s' % (scenario, phase), current['phases'][phase],
+                    previous['phases'][phase])
+    return regressions
+
+def parameters(options):
+    return {
+        'files': options.files,
+        'file_size': options.file_size,
+        'branches': options.branches,
+        'history': options.history,
+        'submodules': options.submodules,
+        'build_cmd': options.build_cmd,
+        'buildploy_args': options.buildploy_args,
+    }
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: run-benchmarks.py [options]')
+    parser.add_option('--files', type='int', default=1000,
+        help='Number of files in the source repository')
+    parser.add_option('--file-size', type='int', default=4096, dest='file_size',
+        help='Size of each file in bytes')
+    parser.add_option('--branches', type='int', default=2,
+        help='Number of branches to build')
+    parser.add_option('--history', type='int', default=10,
+        help='Number of commits of history on top of the initial commit')
+    parser.add_option('--submodules', type='int', default=0,
+        help='Number of submodules')
+    parser.add_option('--build-cmd', default='true', dest='build_cmd',
+        help='Build command used for the benchmark project')
+    parser.add_option('--buildploy-args', default='', dest='buildploy_args',
+        help='Additional buildploy arguments, e.g. "--deploy-engine plumbing"')
+    parser.add_option('--baseline', default=os.path.join(bench_root, 'baseline.json'),
+        help='Baseline file to compare against')
+    parser.add_option('--save-baseline', action='store_true', dest='save_baseline',
+        help='Save results as the new baseline instead of comparing')
+    parser.add_option('--tolerance', type='float', default=0.25,
+        help='Relative slowdown reported as a regression')
+    parser.add_option('--min-delta', type='float', default=0.1, dest='min_delta',
+        help='Slowdowns below this many seconds are ignored')
+    options, args = parser.parse_args()
+    
+    bench_tmp = os.environ.get('BENCH_TMP') or os.path.join(bench_root, 'tmp')
+    if not os.path.exists(bench_tmp):
+        os.mkdir(bench_tmp)
+    bench_dir = os.path.join(bench_tmp, 'run')
+    rm_rf(bench_dir)
+    os.mkdir(bench_dir)
+    
+    print('==> Generating repositories')
+    branches = generate(bench_dir, options)
+    
+    results = {}
+    for scenario in scenarios:
+        if scenario == 'change':
+            change_one_file(bench_dir, branches)
+        print('==> Running %s' % scenario)
+        results[scenario] = summarize(run_buildploy(bench_dir, branches, options, scenario))
+    
+    for scenario in scenarios:
+        result = results[scenario]
+        print('%-8s %8.2fs %5d processes' % (scenario, result['seconds'], result['subprocesses']))
+        for phase in sorted(result['phases']):
+            phase_result = result['phases'][phase]
+            print('  %-10s %8.2fs %5d processes' % (phase,
+                phase_result['seconds'], phase_result['subprocesses']))
+    
+    if options.save_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump({'parameters': parameters(options), 'results': results},
+                f, indent=2, sort_keys=True)
+        print('Saved baseline to %s' % options.baseline)
+        return
+    
+    if not os.path.exists(options.baseline):
+        print('No baseline at %s, use --save-baseline to create one' % options.baseline)
+        return
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    if baseline['parameters'] != parameters(options):
+        print('Baseline was recorded with different parameters, not comparing')
+        return
+    regressions = compare(results, baseline, options)
+    if regressions:
+        print('Regressions:')
+        for regression in regressions:
+            print('  %s' % regression)
+        exit(1)
+    print('No regressions.')
+
+if __name__ == '__main__':
+    main()
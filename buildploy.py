@@ -4,13 +4,18 @@
 # files in different branches to have identical size, and if the filesystem
 # is quick enough the files in different branches may have identical timestamp.
 
-import shutil
 import re
-import optparse
+import hashlib
+import json
 import subprocess
 import os.path
+import stat
 import sys
 import time
+import threading
+import signal
+import collections
+import contextlib
 
 debug = False
 
@@ -24,6 +29,155 @@ else:
 class ConfigurationFileError(base_exception):
     pass
 
+class BuildFailure(base_exception):
+    pass
+
+class PushFailure(BuildFailure):
+    pass
+
+# resource usage of subprocesses recorded by Timings, see wait_for_process
+RUSAGE_FIELDS = ['cpu_seconds', 'max_rss', 'read_bytes', 'written_bytes']
+
+class Timings(object):
+    '''Records wall time, number of subprocesses started, bytes copied and
+    resource usage of subprocesses per branch and phase of a run, and per
+    project when deploying several projects.
+    
+    Phases are tracked per thread, so that branches built in parallel
+    are accounted separately. Subprocesses started outside of any phase
+    are recorded under the `other` phase.
+    '''
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.records = {}
+        self.order = []
+        self.start = time.time()
+        # computing bytes copied requires walking copied trees,
+        # which is only done when a report was requested
+        self.count_bytes = False
+    
+    def record(self, project, branch, phase):
+        key = (project, branch, phase)
+        if key not in self.records:
+            self.records[key] = self.new_record()
+            self.order.append(key)
+        return self.records[key]
+    
+    def new_record(self):
+        record = {'seconds': 0.0, 'subprocesses': 0, 'bytes': 0}
+        for name in RUSAGE_FIELDS:
+            record[name] = 0
+        return record
+    
+    def current(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack:
+            return stack[-1]
+        return (None, None, 'other')
+    
+    @contextlib.contextmanager
+    def phase(self, phase, branch=None, project=None):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        key = (project, branch, phase)
+        with self.lock:
+            self.record(project, branch, phase)
+        self.local.stack.append(key)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.local.stack.pop()
+            with self.lock:
+                self.record(project, branch, phase)['seconds'] += elapsed
+    
+    def add(self, name, amount):
+        project, branch, phase = self.current()
+        with self.lock:
+            self.record(project, branch, phase)[name] += amount
+    
+    def maximum(self, name, value):
+        project, branch, phase = self.current()
+        with self.lock:
+            record = self.record(project, branch, phase)
+            record[name] = max(record[name], value)
+    
+    def reset(self):
+        with self.lock:
+            self.records = {}
+            self.order = []
+            self.start = time.time()
+    
+    def report(self):
+        phases = []
+        totals = {}
+        for key in self.order:
+            project, branch, phase = key
+            record = dict(self.records[key])
+            record.update(project=project, branch=branch, phase=phase)
+            phases.append(record)
+            total = totals.setdefault(phase, self.new_record())
+            for name in total:
+                if name == 'max_rss':
+                    total[name] = max(total[name], record[name])
+                else:
+                    total[name] += record[name]
+        return {
+            'seconds': time.time() - self.start,
+            'subprocesses': sum(record['subprocesses'] for record in phases),
+            'bytes': sum(record['bytes'] for record in phases),
+            'phases': phases,
+            'totals': totals,
+        }
+    
+    def summary(self):
+        report = self.report()
+        lines = ['Timings:']
+        for record in report['phases']:
+            label = record['branch'] or ''
+            if record['project']:
+                label = '%s:%s' % (record['project'], label)
+            line = '  %-20s %-10s %8.2fs %5d processes' % (
+                label, record['phase'],
+                record['seconds'], record['subprocesses'])
+            if record['cpu_seconds']:
+                line += ' %8.2fs cpu %10s peak' % (record['cpu_seconds'],
+                    format_bytes(record['max_rss']))
+            if record['bytes']:
+                line += ' %10s copied' % format_bytes(record['bytes'])
+            lines.append(line)
+        lines.append('  %-31s %8.2fs %5d processes' % ('total',
+            report['seconds'], report['subprocesses']))
+        return "\n".join(lines)
+
+timings = Timings()
+
+def format_bytes(count):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if count < 1024 or unit == 'GB':
+            break
+        count /= 1024.0
+    if unit == 'B':
+        return '%d %s' % (count, unit)
+    return '%.1f %s' % (count, unit)
+
+def tree_size(path):
+    '''Returns total size of files under path, not descending into .git.
+    '''
+    
+    size = 0
+    for root, dirs, files in os.walk(path):
+        if '.git' in dirs:
+            dirs.remove('.git')
+        for file in files:
+            file_path = os.path.join(root, file)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
 def output_to_string(output):
     '''Converts output of a process invoked via subprocess module,
     which is of type bytes on python 3, to a string.
@@ -34,30 +188,190 @@ def output_to_string(output):
     else:
         return output
 
+class CommandTimeout(subprocess.CalledProcessError):
+    def __str__(self):
+        return "Command '%s' timed out" % (self.cmd,)
+
+class CommandOutput(object):
+    '''Receives output of a command line by line, copying it to standard
+    output, prefixed with label if given, and to the log file at log_path
+    if given, and keeps its last lines for error reports.
+    '''
+    
+    # lines written by commands running in different threads are not mixed
+    lock = threading.Lock()
+    
+    def __init__(self, label=None, log_path=None, tail_lines=100):
+        self.label = label
+        self.lines = collections.deque(maxlen=tail_lines)
+        # long lines are written in several pieces, labelled once
+        self.line_started = False
+        if log_path is not None:
+            dir = os.path.dirname(log_path)
+            if not os.path.exists(dir):
+                os.makedirs(dir)
+            self.log = open(log_path, 'wb')
+        else:
+            self.log = None
+    
+    def write(self, line):
+        self.lines.append(line)
+        if self.log is not None:
+            self.log.write(line)
+            self.log.flush()
+        if py3:
+            # build output need not be valid UTF-8
+            text = line.decode('utf8', 'replace')
+        else:
+            text = line
+        if self.label is not None and not self.line_started:
+            text = '[%s] %s' % (self.label, text)
+        self.line_started = not line.endswith(b'\n')
+        with self.lock:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+    
+    def tail(self):
+        return b''.join(self.lines)
+    
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+# default timeout in seconds of commands run, see --command-timeout;
+# kept per thread, as projects deployed together configure their own
+command_defaults = threading.local()
+
+def use_command_timeout(merged_config):
+    '''Makes commands run by the current thread default to the
+    command_timeout of merged_config.
+    '''
+    
+    command_defaults.timeout = merged_config.command_timeout
+
 def run(cmd, **kwargs):
+    '''Runs cmd with subprocess, in the directory given by the cwd keyword
+    argument, and raises CalledProcessError if it fails.
+    
+    Additional keyword arguments:
+    
+    return_stdout: return standard output of the command.
+    return_code: return exit code of the command instead of raising
+        CalledProcessError.
+    output: a CommandOutput receiving standard output and error of the
+        command line by line as they are written.
+    timeout: kill the command, and anything it started, and raise
+        CommandTimeout if it runs longer than this many seconds.
+    '''
+    
     if debug:
         print(repr(cmd), repr(kwargs))
         sys.stdout.flush()
-    if 'return_stdout' in kwargs:
-        return_stdout = kwargs.pop('return_stdout')
+    timings.add('subprocesses', 1)
+    return_stdout = kwargs.pop('return_stdout', False)
+    return_code = kwargs.pop('return_code', False)
+    output = kwargs.pop('output', None)
+    timeout = kwargs.pop('timeout', getattr(command_defaults, 'timeout', None))
+    if return_stdout:
+        kwargs['stdout'] = subprocess.PIPE
+    elif output is not None:
+        kwargs['stdout'] = subprocess.PIPE
+        kwargs['stderr'] = subprocess.STDOUT
+    if timeout:
+        # the command gets its own process group, so that processes
+        # it starts are killed with it
+        if py3:
+            kwargs['start_new_session'] = True
+        else:
+            kwargs['preexec_fn'] = os.setsid
+    
+    p = subprocess.Popen(cmd, **kwargs)
+    timed_out = []
+    if timeout:
+        def kill():
+            timed_out.append(True)
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                # already exited
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
         if return_stdout:
+            # standard output is the only pipe
+            stdout = p.stdout.read()
+            p.stdout.close()
+        elif output is not None:
+            # lines are read in bounded pieces, as e.g. progress output
+            # rewritten with carriage returns may never end a line
+            for line in iter(lambda: p.stdout.readline(65536), b''):
+                output.write(line)
+            p.stdout.close()
+        wait_for_process(p)
+    except BaseException:
+        # e.g. interrupted, or output could not be written: the command
+        # must not be left running with nobody reading its output
+        if p.returncode is None:
             try:
-                from cStringIO import StringIO
-            except ImportError:
-                from io import StringIO
-            io = StringIO()
-            kwargs['stdout'] = subprocess.PIPE
-            p = subprocess.Popen(cmd, **kwargs)
-            stdout, stderr = p.communicate()
-            if p.returncode != 0:
-                raise subprocess.CalledProcessError('Command failed with code %d' % p.returncocde)
-            return stdout
-    if 'return_code' in kwargs:
-        del kwargs['return_code']
-        fn = subprocess.call
+                if timeout:
+                    os.killpg(p.pid, signal.SIGKILL)
+                else:
+                    p.kill()
+            except OSError:
+                # already exited
+                pass
+            if p.stdout is not None:
+                p.stdout.close()
+            wait_for_process(p)
+        raise
+    finally:
+        if timeout:
+            timer.cancel()
+    
+    if timed_out:
+        raise CommandTimeout(p.returncode, cmd)
+    if return_code:
+        return p.returncode
+    if p.returncode != 0:
+        exc = subprocess.CalledProcessError(p.returncode, cmd)
+        if output is not None:
+            exc.output = output.tail()
+        raise exc
+    if return_stdout:
+        return stdout
+    return 0
+
+def wait_for_process(p):
+    '''Waits for the process p to exit, setting its returncode, and adds
+    its resource usage, which includes descendants it waited for, to
+    timings.
+    '''
+    
+    while True:
+        try:
+            pid, status, rusage = os.wait4(p.pid, 0)
+            break
+        except OSError as e:
+            import errno
+            
+            # python 2 does not retry interrupted system calls
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
     else:
-        fn = subprocess.check_call
-    return fn(cmd, **kwargs)
+        p.returncode = os.WEXITSTATUS(status)
+    
+    timings.add('cpu_seconds', rusage.ru_utime + rusage.ru_stime)
+    # block counts are in 512 byte units
+    timings.add('read_bytes', rusage.ru_inblock * 512)
+    timings.add('written_bytes', rusage.ru_oublock * 512)
+    if sys.platform == 'darwin':
+        timings.maximum('max_rss', rusage.ru_maxrss)
+    else:
+        # in kilobytes
+        timings.maximum('max_rss', rusage.ru_maxrss * 1024)
 
 def git_in_dir(dir, args, **kwargs):
     cmd = ['git',
@@ -66,48 +380,711 @@ def git_in_dir(dir, args, **kwargs):
     cmd.extend(args)
     return run(cmd, **kwargs)
 
-def checkout(local_src, build_dir, branch):
+def checkout(local_src, build_dir, branch, merged_config):
+    '''Materializes the source tree of branch for building and returns
+    the directory in which the build should run.
+    
+    With the worktree materialization mode the branch is checked out
+    into its own git worktree, which is built in place; build_dir is
+    not used. Otherwise the branch is checked out in the local source
+    repository and copied into build_dir.
+    '''
+    
+    if merged_config.materialize == 'worktree':
+        worktree_dir = os.path.join(merged_config.work_prefix, 'worktrees', branch)
+        checkout_worktree(local_src, worktree_dir, branch,
+            clean=not merged_config.incremental)
+        update_submodules(worktree_dir, merged_config)
+        return worktree_dir
+    
     git_in_dir(local_src, ['checkout', 'src/%s' % branch])
-    run_in_dir(local_src, ['git', 'submodule', 'init'])
-    run_in_dir(local_src, ['git', 'submodule', 'update'])
-    run(['rsync', '-aI', '--exclude', '.git', local_src + '/', build_dir, '--delete'])
+    update_submodules(local_src, merged_config)
+    copy(local_src, build_dir, merged_config)
+    return build_dir
+
+def checkout_worktree(local_src, worktree_dir, branch, clean=True):
+    '''Checks out branch into a dedicated worktree of the local source
+    repository. Files that did not change since the worktree was last
+    checked out are not rewritten; files that changed, including those
+    modified by the previous build, are rewritten with current timestamps.
+    
+    Unless clean is false, untracked and ignored files, i.e. products
+    of the previous build, are removed.
+    '''
+    
+    if os.path.exists(os.path.join(worktree_dir, '.git')):
+        run_in_dir(worktree_dir, ['git', 'checkout', '-q', '-f', '--detach', 'src/%s' % branch])
+        if clean:
+            run_in_dir(worktree_dir, ['git', 'clean', '-q', '-f', '-f', '-d', '-x'])
+    else:
+        rm_rf(worktree_dir)
+        # forget worktrees whose directories were removed
+        run_in_dir(local_src, ['git', 'worktree', 'prune'])
+        run_in_dir(local_src, ['git', 'worktree', 'add', '--detach', worktree_dir, 'src/%s' % branch])
+
+def update_submodules(dir, merged_config):
+    '''Initializes and checks out the submodules of the work tree at dir.
+    
+    Up to submodule_jobs submodules are fetched in parallel, history is
+    fetched only submodule_depth commits deep if set, and with
+    submodule_cache newly cloned submodules borrow objects from the
+    shared submodule cache.
+    '''
+    
+    if not os.path.exists(os.path.join(dir, '.gitmodules')):
+        return
+    args = ['git', 'submodule', 'update', '--init']
+    if merged_config.submodule_jobs > 1:
+        args += ['--jobs', str(merged_config.submodule_jobs)]
+    if merged_config.submodule_depth:
+        args += ['--depth', str(merged_config.submodule_depth)]
+    if merged_config.submodule_cache:
+        args += ['--reference', fill_submodule_cache(dir, merged_config)]
+    run_in_dir(dir, args)
 
-def copy(src_dir, build_dir):
+# the submodule cache is shared by branches built in parallel
+submodule_cache_lock = threading.Lock()
+
+def fill_submodule_cache(dir, merged_config):
+    '''Makes sure that the bare submodule cache repository under
+    work_prefix has the commits that the submodules of the work tree
+    at dir are checked out at, and returns its path.
+    
+    Submodules whose commits are already in the cache are not fetched.
+    Each submodule's branches are kept under refs/submodules/<url hash>/
+    in the cache, so that its objects are never pruned.
+    '''
+    
+    cache_dir = os.path.join(merged_config.work_prefix, 'submodule-cache')
+    # writes resolved submodule urls into the repository configuration
+    run_in_dir(dir, ['git', 'submodule', 'init'])
+    paths = git_config_values(dir, r'^submodule\..*\.path$', file='.gitmodules')
+    urls = git_config_values(dir, r'^submodule\..*\.url$')
+    commits = {}
+    output = output_to_string(run_in_dir(dir, ['git', 'ls-files', '-s'], return_stdout=True))
+    for line in output.split("\n"):
+        if line.startswith('160000 '):
+            info, path = line.split("\t", 1)
+            commits[path] = info.split()[1]
+    
+    with submodule_cache_lock:
+        if not os.path.exists(cache_dir):
+            run(['git', 'init', '-q', '--bare', cache_dir])
+            # objects may only disappear from the cache while
+            # no clone borrows them
+            run(['git', '--git-dir', cache_dir, 'config', 'gc.auto', '0'])
+        missing = git_missing_objects(cache_dir, list(commits.values()))
+        for key, path in sorted(paths.items()):
+            name = key[len('submodule.'):-len('.path')]
+            url = urls.get('submodule.%s.url' % name)
+            if url is None or commits.get(path) not in missing:
+                continue
+            url_hash = hashlib.sha1(url.encode('utf8')).hexdigest()
+            run(['git', '--git-dir', cache_dir, 'fetch', '-q', '--no-tags', url,
+                '+refs/heads/*:refs/submodules/%s/heads/*' % url_hash])
+    return cache_dir
+
+def git_config_values(dir, regexp, file=None):
+    '''Returns a dict of configuration keys of the repository at dir,
+    or of file if given, matching regexp to their values.
+    '''
+    
+    args = ['git', 'config']
+    if file is not None:
+        args += ['-f', file]
+    # unlike --get-regexp, --list succeeds when nothing matches
+    output = output_to_string(run_in_dir(dir, args + ['--list'], return_stdout=True))
+    values = {}
+    for line in output.split("\n"):
+        key, _, value = line.partition('=')
+        if re.search(regexp, key):
+            values[key] = value
+    return values
+
+def git_missing_objects(git_dir, objects):
+    '''Returns the set of objects which do not exist in the repository
+    at git_dir.
+    '''
+    
+    import tempfile
+    
+    if not objects:
+        return set()
+    with tempfile.TemporaryFile() as f:
+        f.write(("\n".join(objects) + "\n").encode('ascii'))
+        f.seek(0)
+        output = run(['git', '--git-dir', git_dir, 'cat-file', '--batch-check'],
+            stdin=f, return_stdout=True)
+    missing = set()
+    for line in output_to_string(output).split("\n"):
+        if line.endswith(' missing'):
+            missing.add(line.split()[0])
+    return missing
+
+def copy(src_dir, build_dir, merged_config):
+    if not os.path.exists(build_dir):
+        os.makedirs(build_dir)
+    if timings.count_bytes:
+        timings.add('bytes', tree_size(src_dir))
+    if merged_config.materialize == 'reflink' and reflink_copy(src_dir, build_dir):
+        return
     run(['rsync', '-aI', '--exclude', '.git', src_dir + '/', build_dir, '--delete'])
 
+def reflink_copy(src_dir, build_dir):
+    '''Replaces contents of build_dir with a copy of src_dir, sharing file
+    data via reflinks on filesystems that support them (and copying it
+    otherwise).
+    
+    Returns False if the copy tool does not support reflinks, in which
+    case build_dir is left empty.
+    '''
+    
+    # hard links are not used because builds may modify files in place
+    for entry in os.listdir(build_dir):
+        rm_rf(os.path.join(build_dir, entry))
+    entries = [os.path.join(src_dir, entry) for entry in os.listdir(src_dir)
+        if entry != '.git']
+    if not entries:
+        return True
+    try:
+        run(['cp', '-a', '--reflink=auto'] + entries + [build_dir])
+    except subprocess.CalledProcessError:
+        # e.g. cp without --reflink support
+        for entry in os.listdir(build_dir):
+            rm_rf(os.path.join(build_dir, entry))
+        return False
+    # submodule checkouts contain .git files or directories
+    for root, dirs, files in os.walk(build_dir):
+        if '.git' in dirs:
+            dirs.remove('.git')
+            rm_rf(os.path.join(root, '.git'))
+        if '.git' in files:
+            os.unlink(os.path.join(root, '.git'))
+    return True
+
 def run_in_dir(dir, cmd, **kwargs):
-    # for the benefit of fork-less platforms
-    cwd = os.getcwd()
-    os.chdir(dir)
+    # the working directory is passed to the child rather than changed
+    # for the whole process, so that commands may run in several threads
+    kwargs['cwd'] = dir
+    return run(cmd, **kwargs)
+
+def build(build_dir, branch, merged_config):
+    '''Runs the build command in build_dir, streaming its output, which
+    is labeled with the branch when several builds may run at a time,
+    and also written to log_dir if configured.
+    '''
+    
+    if merged_config.jobs > 1 or merged_config.project is not None:
+        label = branch
+        if merged_config.project is not None:
+            label = '%s:%s' % (merged_config.project, branch)
+    else:
+        label = None
+    if merged_config.log_dir:
+        log_dir = merged_config.log_dir
+        if merged_config.project is not None:
+            # projects deployed by one process may share log_dir
+            log_dir = os.path.join(log_dir, branch_file_name(merged_config.project))
+        log_path = os.path.join(log_dir, branch_file_name(branch) + '.log')
+    else:
+        log_path = None
+    output = CommandOutput(label, log_path)
     try:
-        return run(cmd, **kwargs)
+        if merged_config.build_steps:
+            run_build_steps(build_dir, branch, merged_config, output)
+        if merged_config.build_cmd:
+            return run_in_dir(build_dir, limited_command(merged_config.build_cmd, merged_config),
+                output=output, timeout=merged_config.build_timeout)
     finally:
-        os.chdir(cwd)
+        output.close()
 
-def build(build_dir, branch, merged_config):
-    return run_in_dir(build_dir, merged_config.build_cmd, shell=True)
+def limited_command(cmd, merged_config):
+    '''Returns arguments running the shell command cmd with the configured
+    max_memory, cpu_time and nice limits.
+    
+    The limits are resource limits, which processes started by the
+    command inherit, so they apply to each process of the build rather
+    than to all of them together. max_memory limits the data segment
+    size, as address space limits break programs which reserve much
+    more memory than they use.
+    '''
+    
+    limits = []
+    if merged_config.max_memory is not None:
+        limits.append('ulimit -d %d' % (merged_config.max_memory // 1024))
+    if merged_config.cpu_time is not None:
+        limits.append('ulimit -t %d' % merged_config.cpu_time)
+    script = ''.join('%s || exit 1\n' % limit for limit in limits) + cmd
+    args = ['/bin/sh', '-c', script]
+    if merged_config.nice is not None:
+        args = ['nice', '-n', str(merged_config.nice)] + args
+    return args
+
+def run_build_steps(build_dir, branch, merged_config, output):
+    '''Runs the configured build steps in order in build_dir.
+    
+    A step whose inputs in the source tree of branch, its command and
+    its outputs match a previous run has its outputs restored from the
+    step cache instead of being run. Steps always run when building
+    the work tree, which has no source tree to compare.
+    '''
+    
+    if merged_config.work_tree:
+        entries = None
+    else:
+        local_src = os.path.join(merged_config.work_prefix, 'src')
+        entries = source_tree_entries(local_src, 'refs/remotes/src/%s' % branch)
+    cache_dir = os.path.join(merged_config.work_prefix, 'step-cache')
+    for step in merged_config.build_steps:
+        if entries is not None:
+            entry_dir = os.path.join(cache_dir, build_step_key(step, entries))
+            with cache_lock(cache_dir):
+                cached = os.path.isdir(entry_dir)
+                if cached:
+                    restore_step_outputs(entry_dir, build_dir, step)
+                    # entries are evicted least recently used first
+                    os.utime(entry_dir, None)
+            if cached:
+                print('Restored outputs of step %s of %s from cache' % (step['name'], branch))
+                continue
+        run_in_dir(build_dir, limited_command(step['cmd'], merged_config),
+            output=output, timeout=merged_config.build_timeout)
+        if entries is not None:
+            save_step_outputs(entry_dir, build_dir, step)
+            with cache_lock(cache_dir):
+                evict_step_cache(cache_dir, merged_config.step_cache_size, entry_dir)
+
+def source_tree_entries(local_src, ref):
+    '''Returns a list of paths and object ids of all blobs, trees and
+    submodules in the tree of ref, from a single ls-tree.
+    '''
+    
+    output = git_in_dir(local_src, ['ls-tree', '-r', '-t', '-z', '--full-tree', ref],
+        return_stdout=True)
+    entries = []
+    for record in output_to_string(output).split('\0'):
+        if record:
+            info, path = record.split('\t', 1)
+            entries.append((path, info.split()[2]))
+    return entries
+
+def build_step_key(step, entries):
+    '''Returns a hash of a build step's command, outputs and the object
+    ids of source tree entries matching its inputs.
+    
+    Inputs are paths, which match files and directories, or globs.
+    Directories are identified by their tree ids, so that their contents
+    do not need to be listed or read.
+    '''
+    
+    import fnmatch
+    
+    inputs = []
+    for pattern in step['inputs']:
+        pattern = pattern.rstrip('/')
+        inputs.append([pattern, [entry for entry in entries
+            if entry[0] == pattern or fnmatch.fnmatch(entry[0], pattern)]])
+    key = json.dumps([step['name'], step['cmd'], step['outputs'], inputs], sort_keys=True)
+    return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+def save_step_outputs(entry_dir, build_dir, step):
+    import tempfile
+    
+    cache_dir = os.path.dirname(entry_dir)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # created concurrently by a build of another branch
+            if not os.path.isdir(cache_dir):
+                raise
+    # builds of several branches may save the same step at a time;
+    # names with a dot are not cache entries, see evict_step_cache
+    tmp_dir = tempfile.mkdtemp(prefix='.save-', dir=cache_dir)
+    try:
+        outputs_dir = os.path.join(tmp_dir, 'outputs')
+        for path in step['outputs']:
+            src_path = os.path.join(build_dir, path)
+            if not os.path.lexists(src_path):
+                raise BuildFailure('Build step %s did not produce %s' % (step['name'], path))
+            dest_path = os.path.join(outputs_dir, path)
+            if not os.path.isdir(os.path.dirname(dest_path)):
+                os.makedirs(os.path.dirname(dest_path))
+            run(['cp', '-a', '--reflink=auto', src_path, dest_path])
+        with open(os.path.join(tmp_dir, 'size'), 'w') as f:
+            f.write('%d\n' % tree_size(outputs_dir))
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # saved concurrently by a build of another branch
+            if not os.path.isdir(entry_dir):
+                raise
+    finally:
+        rm_rf(tmp_dir)
+
+def restore_step_outputs(entry_dir, build_dir, step):
+    for path in step['outputs']:
+        dest_path = os.path.join(build_dir, path)
+        if os.path.islink(dest_path):
+            os.unlink(dest_path)
+        else:
+            rm_rf(dest_path)
+        if not os.path.isdir(os.path.dirname(dest_path)):
+            os.makedirs(os.path.dirname(dest_path))
+        run(['cp', '-a', '--reflink=auto', os.path.join(entry_dir, 'outputs', path), dest_path])
+
+def evict_step_cache(cache_dir, max_size, keep):
+    '''Removes least recently used entries of the step cache until their
+    total size is at most max_size. The entry keep is never removed.
+    '''
+    
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        size_path = os.path.join(entry_dir, 'size')
+        if '.' in name or not os.path.exists(size_path):
+            continue
+        with open(size_path) as f:
+            size = int(f.read())
+        entries.append((os.path.getmtime(entry_dir), entry_dir, size))
+    total = sum(entry[2] for entry in entries)
+    for mtime, entry_dir, size in sorted(entries):
+        if total <= max_size:
+            break
+        if entry_dir != keep:
+            rm_rf(entry_dir)
+            total -= size
+
+def branch_file_name(branch):
+    # branch names may contain slashes
+    return branch.replace('%', '%25').replace('/', '%2F')
+
+class Scheduler(object):
+    '''Shares job slots between projects deployed by one process.
+    
+    There is a limit on the number of jobs of each kind, builds and
+    network operations, running at a time. When a slot frees up, it
+    goes to a waiting job of the project with the highest priority;
+    among projects of equal priority, to the project with the fewest
+    running jobs of that kind, and then to the job waiting longest.
+    '''
+    
+    def __init__(self, limits):
+        self.limits = limits
+        self.condition = threading.Condition()
+        self.running = {}
+        self.waiting = []
+        self.sequence = 0
+    
+    def running_count(self, kind, project=None):
+        return self.running.get((kind, project), 0)
+    
+    def next_job(self, kind):
+        jobs = [job for job in self.waiting if job[0] == kind]
+        return min(jobs, key=lambda job: (-job[2], self.running_count(kind, job[1]), job[3]))
+    
+    @contextlib.contextmanager
+    def slot(self, kind, project, priority):
+        with self.condition:
+            self.sequence += 1
+            job = (kind, project, priority, self.sequence)
+            self.waiting.append(job)
+            while (self.running_count(kind) >= self.limits[kind] or
+                    self.next_job(kind) != job):
+                self.condition.wait()
+            self.waiting.remove(job)
+            for key in [(kind, None), (kind, project)]:
+                self.running[key] = self.running.get(key, 0) + 1
+            # further slots may be free for other waiting jobs
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                for key in [(kind, None), (kind, project)]:
+                    self.running[key] -= 1
+                self.condition.notify_all()
+
+@contextlib.contextmanager
+def unlimited_slot():
+    yield
+
+def job_slot(merged_config, kind):
+    '''Returns a context manager holding a `build` or `network` job slot
+    of the scheduler shared by projects, if merged_config is one of
+    several projects being deployed.
+    '''
+    
+    if merged_config.scheduler is None:
+        return unlimited_slot()
+    return merged_config.scheduler.slot(kind, merged_config.project, merged_config.priority)
+
+def build_branches_in_parallel(local_src, branches, merged_config, on_finished=None):
+    '''Checks out and builds each of the specified branches in its own
+    build directory, running up to merged_config.jobs builds at a time.
+    
+    Checkouts go through the shared local source repository and are
+    therefore performed one at a time; builds run concurrently.
+    
+    If given, on_finished is called from the building thread with the
+    branch and its build directory, or None if the build failed, as
+    soon as each build finishes.
+    
+    Returns a dictionary mapping branch names to build directories of
+    branches that built successfully, and a dictionary mapping branch
+    names to formatted tracebacks of branches that failed.
+    '''
+    
+    import traceback
+    
+    builds_dir = os.path.join(merged_config.work_prefix, 'builds')
+    pending = list(branches)
+    built = {}
+    failed = {}
+    lock = threading.Lock()
+    checkout_lock = threading.Lock()
+    
+    def worker():
+        use_command_timeout(merged_config)
+        while True:
+            with lock:
+                if not pending:
+                    return
+                branch = pending.pop(0)
+            try:
+                with checkout_lock:
+                    with timings.phase('checkout', branch, merged_config.project):
+                        build_dir = checkout(local_src, os.path.join(builds_dir, branch),
+                            branch, merged_config)
+                with job_slot(merged_config, 'build'):
+                    with timings.phase('build', branch, merged_config.project):
+                        build(build_dir, branch, merged_config)
+            except Exception:
+                msg = traceback.format_exc()
+                sys.stderr.write('Build of branch %s failed:\n%s' % (branch, msg))
+                sys.stderr.flush()
+                with lock:
+                    failed[branch] = msg
+                build_dir = None
+            else:
+                with lock:
+                    built[branch] = build_dir
+            if on_finished is not None:
+                on_finished(branch, build_dir)
+    
+    threads = []
+    for i in range(min(merged_config.jobs, len(branches))):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return built, failed
+
+class RefStore(object):
+    '''Reads refs of a repository, along with trees and messages of the
+    commits they point to, using a single git process, and caches them.
+    
+    Refs created or updated through buildploy are recorded with set()
+    so that the cache does not need to be reloaded.
+    '''
+    
+    def __init__(self, dir, patterns=None):
+        self.dir = dir
+        self.patterns = patterns or ['refs/heads', 'refs/remotes']
+        self.refs = None
+    
+    def load(self):
+        format = '%(refname)%00%(objectname)%00%(tree)%00%(contents)%00'
+        output = git_in_dir(self.dir, ['for-each-ref', '--format=' + format] + self.patterns,
+            return_stdout=True)
+        fields = output_to_string(output).split('\0')
+        refs = {}
+        # every record is terminated by a newline, which ends up
+        # at the start of the following record's refname
+        for i in range(0, len(fields) - 1, 4):
+            refname = fields[i].lstrip('\n')
+            refs[refname] = (fields[i + 1], fields[i + 2] or None, fields[i + 3])
+        self.refs = refs
+    
+    def get(self, refname):
+        if self.refs is None:
+            self.load()
+        return self.refs.get(refname)
+    
+    def exists(self, refname):
+        return self.get(refname) is not None
+    
+    def commit(self, refname):
+        ref = self.get(refname)
+        return ref and ref[0]
+    
+    def tree(self, refname):
+        ref = self.get(refname)
+        return ref and ref[1]
+    
+    def message(self, refname):
+        ref = self.get(refname)
+        return ref and ref[2]
+    
+    def set(self, refname, commit=None):
+        if self.refs is None:
+            self.load()
+        self.refs[refname] = (commit, None, None)
+    
+    def names(self, prefix):
+        if self.refs is None:
+            self.load()
+        return sorted(refname[len(prefix):] for refname in self.refs
+            if refname.startswith(prefix))
+    
+    def local_branches(self):
+        return self.names('refs/heads/')
+    
+    def remote_branches(self):
+        return self.names('refs/remotes/')
 
 def git_list_local_branches(dir):
-    branches = []
-    output = git_in_dir(dir, ['branch'], return_stdout=True)
-    output = output_to_string(output)
-    for line in output.split("\n"):
-        line = line.strip()
-        match = re.match(r'(\*\s+)?(\S+)', line)
-        if match:
-            branches.append(match.group(2))
-    return branches
+    return RefStore(dir, ['refs/heads']).local_branches()
 
 def git_list_remote_branches(dir):
-    branches = []
-    output = git_in_dir(dir, ['branch', '-r'], return_stdout=True)
-    output = output_to_string(output)
+    return RefStore(dir, ['refs/remotes']).remote_branches()
+
+def git_remote_heads(dir, remote, branches):
+    '''Returns a dict mapping those of the specified branches that exist
+    in remote to the commits they point to.
+    '''
+    
+    args = ['ls-remote', '--heads', remote] + ['refs/heads/%s' % branch for branch in branches]
+    output = output_to_string(git_in_dir(dir, args, return_stdout=True))
+    heads = {}
     for line in output.split("\n"):
-        line = line.strip()
-        match = re.match(r'(\S+)', line)
-        if match:
-            branches.append(match.group(1))
-    return branches
+        fields = line.split()
+        if len(fields) == 2 and fields[1].startswith('refs/heads/'):
+            heads[fields[1][len('refs/heads/'):]] = fields[0]
+    return heads
+
+def git_list_remote_heads(dir, remote, branches):
+    '''Returns those of the specified branches that exist in remote.
+    '''
+    
+    heads = git_remote_heads(dir, remote, branches)
+    return [branch for branch in branches if branch in heads]
+
+def init_repo(dir, remote, url):
+    if not os.path.exists(dir):
+        run(['git', 'init', dir])
+        git_in_dir(dir, ['remote', 'add', remote, url])
+
+def fetch_branches(dir, remote, branches, merged_config):
+    '''Fetches only the specified branches of remote into their
+    remote-tracking refs, honoring fetch depth and filter settings.
+    '''
+    
+    if merged_config.object_cache:
+        use_object_cache(dir, remote, merged_config.object_cache)
+    if not branches:
+        return
+    if merged_config.object_cache:
+        fetch_branches_via_object_cache(dir, remote, branches, merged_config)
+        return
+    args = ['fetch', '--no-tags']
+    if merged_config.fetch_depth:
+        args += ['--depth', str(merged_config.fetch_depth)]
+    if merged_config.fetch_filter:
+        # git marks the remote as a promisor on the first filtered fetch
+        args += ['--filter=%s' % merged_config.fetch_filter]
+    args.append(remote)
+    for branch in branches:
+        args.append('+refs/heads/%s:refs/remotes/%s/%s' % (branch, remote, branch))
+    git_in_dir(dir, args)
+
+def fetch_branches_via_object_cache(dir, remote, branches, merged_config):
+    '''Fetches the specified branches of remote into the shared object
+    cache, and from there into the remote-tracking refs of the repository
+    at dir, which borrows objects from the cache.
+    
+    The cache keeps the branches of each remote under
+    refs/cache/<url hash>/, so that fetching a repository that another
+    project already fetched only transfers new objects.
+    '''
+    
+    cache_dir = os.path.abspath(merged_config.object_cache)
+    url = output_to_string(git_in_dir(dir, ['config', 'remote.%s.url' % remote],
+        return_stdout=True)).strip()
+    prefix = object_cache_prefix(url)
+    with cache_lock(cache_dir):
+        init_object_cache(cache_dir)
+        args = ['git', '--git-dir', cache_dir, 'fetch', '--no-tags', url]
+        for branch in branches:
+            args.append('+refs/heads/%s:%s/%s' % (branch, prefix, branch))
+        run(args)
+    
+    # objects are already available through alternates, only refs are copied
+    args = ['fetch', '--no-tags', cache_dir]
+    for branch in branches:
+        args.append('+%s/%s:refs/remotes/%s/%s' % (prefix, branch, remote, branch))
+    git_in_dir(dir, args)
+
+@contextlib.contextmanager
+def cache_lock(cache_dir):
+    '''Serializes updates of a cache directory, such as the object cache,
+    which may be shared by several buildploy processes.
+    '''
+    
+    import fcntl
+    
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    with open(os.path.join(cache_dir, 'buildploy.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def init_object_cache(cache_dir):
+    if os.path.exists(os.path.join(cache_dir, 'objects')):
+        return
+    run(['git', 'init', '-q', '--bare', cache_dir])
+    # Repositories borrowing objects from the cache may reference objects
+    # which are no longer reachable from any ref of the cache, e.g. after
+    # a branch was force pushed. gc in the cache must never delete them.
+    run(['git', '--git-dir', cache_dir, 'config', 'gc.pruneExpire', 'never'])
+
+def object_cache_prefix(url):
+    return 'refs/cache/%s/heads' % hashlib.sha1(url.encode('utf8')).hexdigest()
+
+def use_object_cache(dir, remote, cache_dir):
+    '''Makes the repository at dir borrow objects from the object cache.
+    
+    A repository which already fetched from remote first copies its
+    remote-tracking branches into the cache, so that the cache does not
+    download their history again. Objects the repository has are then
+    dropped from its own object store, by repacking with -l.
+    '''
+    
+    cache_objects = os.path.join(os.path.realpath(cache_dir), 'objects')
+    alternates_path = os.path.join(dir, '.git', 'objects', 'info', 'alternates')
+    if os.path.exists(alternates_path):
+        with open(alternates_path) as f:
+            if cache_objects in f.read().split("\n"):
+                return
+    with cache_lock(cache_dir):
+        init_object_cache(cache_dir)
+        remote_refs = git_in_dir(dir, ['for-each-ref', '--count=1', 'refs/remotes/%s/' % remote],
+            return_stdout=True)
+        if remote_refs.strip():
+            url = output_to_string(git_in_dir(dir, ['config', 'remote.%s.url' % remote],
+                return_stdout=True)).strip()
+            # objects are kept in a pack, loose objects of the repository
+            # are only dropped if the cache has them packed
+            run(['git', '--git-dir', cache_dir, '-c', 'fetch.unpackLimit=1',
+                'fetch', '--no-tags', '-q', os.path.abspath(dir),
+                '+refs/remotes/%s/*:%s/*' % (remote, object_cache_prefix(url))])
+    with open(alternates_path, 'a') as f:
+        f.write(cache_objects + "\n")
+    git_in_dir(dir, ['repack', '-a', '-d', '-l', '-q'])
 
 def rm_f(path):
     if os.path.exists(path):
@@ -117,6 +1094,8 @@ def rm_rf(path):
     '''Removes specified file or directory tree.
     '''
     
+    import shutil
+    
     if not os.path.exists(path):
         return
     
@@ -125,27 +1104,647 @@ def rm_rf(path):
     else:
         os.unlink(path)
 
-def git_reset_to_empty_tree(deploy_dir, branch):
-    # https://wincent.com/wiki/Creating_independent_branches_with_Git
-    git_in_dir(deploy_dir, ['symbolic-ref', 'HEAD', 'refs/heads/newbranch'])
-    index_path = os.path.join(deploy_dir, '.git/index')
+def git_empty_root_commit(deploy_dir):
+    '''Creates a parentless commit with an empty tree and returns its id.
+    '''
+    
+    tree = git_in_dir(deploy_dir, ['hash-object', '-t', 'tree', '-w', os.devnull],
+        return_stdout=True)
+    tree = output_to_string(tree).strip()
+    commit = git_in_dir(deploy_dir, ['commit-tree', tree, '-m', 'New tree'],
+        return_stdout=True)
+    return output_to_string(commit).strip()
+
+SOURCE_COMMIT_TRAILER = 'Buildploy-Source-Commit'
+CONFIG_HASH_TRAILER = 'Buildploy-Config-Hash'
+
+def build_config_hash(merged_config):
+    '''Returns a hash of the configuration settings that affect build output.
+    '''
+    
+    settings = {
+        'src_repo': merged_config.src_repo,
+        'build_cmd': merged_config.build_cmd,
+        'deploy_subdir': merged_config.deploy_subdir,
+    }
+    if merged_config.build_steps:
+        settings['build_steps'] = merged_config.build_steps
+    if merged_config.artifact_store:
+        # artifacts are committed as pointer files
+        settings['artifacts'] = artifact_settings(merged_config)
+    settings = json.dumps(settings, sort_keys=True)
+    return hashlib.sha1(settings.encode('utf8')).hexdigest()
+
+def build_commit_message(source_commit, config_hash):
+    message = 'Built at %s' % time.strftime('%a %b %d %H:%M:%S %Y %z')
+    if source_commit is not None:
+        message += "\n\n%s: %s\n%s: %s" % (
+            SOURCE_COMMIT_TRAILER, source_commit,
+            CONFIG_HASH_TRAILER, config_hash)
+    return message
+
+def parse_build_trailers(message):
+    '''Returns a dictionary of buildploy trailers found in a deploy
+    commit message.
+    '''
+    
+    trailers = {}
+    for line in message.split("\n"):
+        match = re.match(r'(%s|%s):\s*(\S+)\s*$' % (SOURCE_COMMIT_TRAILER, CONFIG_HASH_TRAILER), line)
+        if match:
+            trailers[match.group(1)] = match.group(2)
+    return trailers
+
+def git_rev_parse(dir, revs):
+    '''Resolves the specified revisions to object ids using a single
+    git process.
+    '''
+    
+    if not revs:
+        return []
+    output = output_to_string(git_in_dir(dir, ['rev-parse'] + revs, return_stdout=True))
+    return output.split()
+
+def group_branches_by_tree(branches, source_trees):
+    '''Groups branches whose sources have identical trees, so that each
+    distinct tree is built once.
+    
+    Returns a list of lists of branches in order of first appearance.
+    '''
+    
+    groups = []
+    groups_by_tree = {}
+    for branch in branches:
+        tree = source_trees[branch]
+        if tree in groups_by_tree:
+            groups_by_tree[tree].append(branch)
+        else:
+            group = [branch]
+            groups_by_tree[tree] = group
+            groups.append(group)
+    return groups
+
+def deploy_base_ref(branch, deploy_refs):
+    '''Returns the ref that a deploy of branch will be committed on top of,
+    or None if the branch does not exist in the deployment repository.
+    
+    The remote branch takes precedence over the local one, so that
+    the local deployment repository is brought up to date with the
+    remote before committing.
+    '''
+    
+    for refname in ['refs/remotes/deploy/%s' % branch, 'refs/heads/%s' % branch]:
+        if deploy_refs.exists(refname):
+            return refname
+    return None
+
+def deploy_parent_ref(branch, merged_config, deploy_refs):
+    '''Returns the ref that the next deploy commit of branch will have as
+    its parent, or None if the deploy commit should have no parent.
+    
+    A branch that does not yet exist in the deployment repository
+    starts from master, if master exists.
+    '''
+    
+    if merged_config.discard_deploy_history:
+        return None
+    ref = deploy_base_ref(branch, deploy_refs)
+    if ref is None and branch != 'master':
+        ref = deploy_base_ref('master', deploy_refs)
+    return ref
+
+def find_unchanged_branches(deploy_dir, branches, source_commits, config_hash, deploy_refs):
+    '''Returns the subset of branches whose deploy commit records the
+    current source commit and build configuration, and the subset of
+    those whose deploy commit has not been pushed yet.
+    
+    A local deploy commit ahead of the remote branch, left behind by a
+    push that failed, is pushed rather than built again.
+    '''
+    
+    unchanged = []
+    unpushed = []
+    for branch in branches:
+        remote_ref = 'refs/remotes/deploy/%s' % branch
+        local_ref = 'refs/heads/%s' % branch
+        refs = []
+        if deploy_refs.exists(local_ref) and deploy_refs.commit(local_ref) != deploy_refs.commit(remote_ref):
+            if not deploy_refs.exists(remote_ref) or git_in_dir(deploy_dir,
+                    ['merge-base', '--is-ancestor', remote_ref, local_ref], return_code=True) == 0:
+                refs.append(local_ref)
+        if deploy_refs.exists(remote_ref):
+            refs.append(remote_ref)
+        for ref in refs:
+            trailers = parse_build_trailers(deploy_refs.message(ref) or '')
+            if trailers.get(SOURCE_COMMIT_TRAILER) == source_commits[branch] and \
+                    trailers.get(CONFIG_HASH_TRAILER) == config_hash:
+                unchanged.append(branch)
+                if ref == local_ref:
+                    unpushed.append(branch)
+                break
+    return unchanged, unpushed
+
+def deploy_source_dir(build_dir, merged_config):
+    if merged_config.deploy_subdir is not None:
+        return os.path.join(build_dir, merged_config.deploy_subdir)
+    else:
+        return build_dir
+
+def commit_build(deploy_dir, build_dir, branch, message, merged_config, deploy_refs):
+    '''Commits contents of build_dir (or its deploy_subdir) to the specified
+    branch of the local deployment repository.
+    
+    deploy_refs is updated with the branch being committed to. Returns
+    True if the branch's history was rewritten by retention, in which
+    case it has to be force pushed.
+    '''
+    
+    if merged_config.deploy_engine == 'plumbing':
+        commit_build_with_plumbing(deploy_dir, build_dir, branch, message,
+            merged_config, deploy_refs)
+    else:
+        commit_build_in_work_tree(deploy_dir, build_dir, branch, message,
+            merged_config, deploy_refs)
+    if merged_config.keep_last is not None or merged_config.keep_days is not None:
+        if apply_retention(deploy_dir, branch, merged_config, deploy_refs):
+            return True
+        # a rewrite whose push failed earlier still has to be forced
+        remote_ref = 'refs/remotes/deploy/%s' % branch
+        if deploy_refs.exists(remote_ref):
+            return git_in_dir(deploy_dir, ['merge-base', '--is-ancestor', deploy_refs.commit(remote_ref),
+                'refs/heads/%s' % branch], return_code=True) != 0
+    return False
+
+# fields of deploy commits which are preserved when history is rewritten
+RETAINED_COMMIT_FORMAT = '%x00'.join(['%H', '%T', '%an', '%ae', '%ad', '%cn', '%ce', '%cd', '%B'])
+
+def apply_retention(deploy_dir, branch, merged_config, deploy_refs):
+    '''Rewrites the branch in the local deployment repository so that it
+    contains only the deploy commits allowed by keep_last and keep_days,
+    on top of a fresh root commit.
+    
+    Every rewrite makes the next push a forced update, which servers
+    cannot fast-forward to, so the branch is only rewritten once its
+    history is twice as long as what is kept: more than 2 * keep_last
+    commits, or commits older than 2 * keep_days days. Deploys in between
+    add commits on top of the rewritten history as usual.
+    
+    The newest commit is always kept. Kept commits retain their trees,
+    messages, authors and dates. Returns True if the branch was rewritten.
+    '''
+    
+    refname = 'refs/heads/%s' % branch
+    args = ['log', '-z', '--first-parent', '--date=raw', '--format=' + RETAINED_COMMIT_FORMAT]
+    if merged_config.keep_last is not None:
+        # one more commit tells whether the history is due for a rewrite
+        args += ['-n', str(2 * merged_config.keep_last + 1)]
+    output = output_to_string(git_in_dir(deploy_dir, args + [refname], return_stdout=True))
+    fields = output.split('\0')
+    commits = []
+    for i in range(0, len(fields) - 8, 9):
+        commits.append(fields[i:i + 9])
+    
+    def committed_at(commit):
+        return int(commit[7].split()[0])
+    
+    due = False
+    if merged_config.keep_last is not None and len(commits) > 2 * merged_config.keep_last:
+        due = True
+    if merged_config.keep_days is not None and \
+            committed_at(commits[-1]) < time.time() - 2 * merged_config.keep_days * 86400:
+        due = True
+    if not due:
+        return False
+    
+    keep = commits
+    if merged_config.keep_last is not None:
+        keep = keep[:merged_config.keep_last]
+    if merged_config.keep_days is not None:
+        cutoff = time.time() - merged_config.keep_days * 86400
+        recent = 1
+        while recent < len(keep) and committed_at(keep[recent]) >= cutoff:
+            recent += 1
+        keep = keep[:recent]
+    if len(keep) == len(commits):
+        return False
+    
+    parent = None
+    for sha, tree, an, ae, ad, cn, ce, cd, message in reversed(keep):
+        env = dict(os.environ)
+        env.update({
+            'GIT_AUTHOR_NAME': an, 'GIT_AUTHOR_EMAIL': ae, 'GIT_AUTHOR_DATE': ad,
+            'GIT_COMMITTER_NAME': cn, 'GIT_COMMITTER_EMAIL': ce, 'GIT_COMMITTER_DATE': cd,
+        })
+        args = ['commit-tree', tree, '-m', message.rstrip('\n')]
+        if parent is not None:
+            args += ['-p', parent]
+        parent = output_to_string(git_in_dir(deploy_dir, args, env=env, return_stdout=True)).strip()
+    old_tip = keep[0][0]
+    git_in_dir(deploy_dir, ['update-ref', refname, parent, old_tip])
+    deploy_refs.set(refname, parent)
+    print('Rewrote history of %s, keeping %d deploy commits' % (branch, len(keep)))
+    
+    if merged_config.deploy_engine == 'worktree' and merged_config.deploy_sync == 'manifest':
+        # the work tree still matches the manifest, only the commit changed
+        manifest_path = deploy_manifest_path(merged_config, branch)
+        manifest = load_deploy_manifest(manifest_path)
+        if manifest is not None and manifest['commit'] == old_tip:
+            save_deploy_manifest(manifest_path, parent, manifest['files'], manifest.get('artifacts'))
+    return True
+
+def compact_deploy_repo(deploy_dir):
+    '''Drops reflog entries of commits removed by retention and lets git
+    repack the local deployment repository if enough objects accumulated.
+    '''
+    
+    git_in_dir(deploy_dir, ['reflog', 'expire', '--expire-unreachable=now', '--all'])
+    # gc would otherwise detach and race with the next run
+    git_in_dir(deploy_dir, ['-c', 'gc.autoDetach=false', 'gc', '--auto', '--quiet'])
+
+def commit_build_with_plumbing(deploy_dir, build_dir, branch, message, merged_config, deploy_refs):
+    '''Hashes build output directly into the deployment repository's object
+    store and commits it on top of the branch's previous deploy commit,
+    without checking out a deploy work tree.
+    '''
+    
+    parent = deploy_parent_ref(branch, merged_config, deploy_refs)
+    
+    deploy_src = deploy_source_dir(build_dir, merged_config)
+    if has_nested_git_dirs(deploy_src):
+        # git would record checked out submodules as gitlinks rather than
+        # their files, so the output is copied without .git entries first
+        staging_dir = os.path.join(merged_config.work_prefix, 'staging')
+        run(['rsync', '-aI', '--exclude', '.git', deploy_src + '/', staging_dir, '--delete'])
+        deploy_src = staging_dir
+    git_dir = os.path.join(deploy_dir, '.git')
+    # a fresh index is used for every commit: files in different branches
+    # may have identical size and timestamp, see the note at the top
+    index_path = os.path.join(git_dir, 'buildploy-index')
     rm_f(index_path)
-    output = git_in_dir(deploy_dir, ['ls-files', '-o'], return_stdout=True)
-    files = output_to_string(output)
-    for file in files.split("\n"):
-        file = file.strip()
-        if file:
-            rm_rf(os.path.join(deploy_dir, file))
-    git_in_dir(deploy_dir, ['commit', '--allow-empty', '-m', 'New tree'])
-    # XXX test both paths
-    if branch in git_list_local_branches(deploy_dir):
-        git_in_dir(deploy_dir, ['checkout', branch])
-        git_in_dir(deploy_dir, ['reset', '--hard', 'newbranch'])
+    env = dict(os.environ)
+    env['GIT_INDEX_FILE'] = index_path
+    git = ['git', '--git-dir', git_dir, '--work-tree', deploy_src]
+    if merged_config.artifact_store:
+        artifacts = store_artifacts(deploy_src, merged_config)
+    else:
+        artifacts = None
+    try:
+        if artifacts is not None:
+            add_with_artifact_pointers(git, deploy_src, artifacts, env)
+        else:
+            run(git + ['add', '-A', '.'], cwd=deploy_src, env=env)
+        tree = run(git + ['write-tree'], env=env, return_stdout=True)
+    finally:
+        rm_f(index_path)
+    tree = output_to_string(tree).strip()
+    
+    args = ['commit-tree', tree, '-m', message]
+    if parent is not None:
+        args += ['-p', parent]
+    commit = git_in_dir(deploy_dir, args, return_stdout=True)
+    commit = output_to_string(commit).strip()
+    git_in_dir(deploy_dir, ['update-ref', 'refs/heads/%s' % branch, commit])
+    deploy_refs.set('refs/heads/%s' % branch, commit)
+
+def has_nested_git_dirs(dir):
+    '''Returns whether any subdirectory of dir contains a .git entry,
+    as checked out submodules do.
+    '''
+    
+    for root, dirs, files in os.walk(dir):
+        if root == dir:
+            if '.git' in dirs:
+                dirs.remove('.git')
+            continue
+        if '.git' in dirs or '.git' in files:
+            return True
+    return False
+
+def add_with_artifact_pointers(git, deploy_src, artifacts, env):
+    '''Adds files under deploy_src to the index given by env, with pointer
+    files and the artifact manifest in place of artifacts, which are
+    never hashed into the deployment repository.
+    '''
+    
+    import tempfile
+    
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        excludes_path = os.path.join(tmp_dir, 'excludes')
+        with open(excludes_path, 'w') as f:
+            for path in sorted(artifacts):
+                f.write('/' + re.sub(r'([\\*?\[!# ])', r'\\\1', path) + '\n')
+        run(git[:1] + ['-c', 'core.excludesFile=' + excludes_path] + git[1:] + ['add', '-A', '.'],
+            cwd=deploy_src, env=env)
+        
+        entries = [(path, git_file_mode(mode), artifact_pointer(digest, size))
+            for path, (size, mode, digest) in sorted(artifacts.items())]
+        if artifacts:
+            entries.append((ARTIFACT_MANIFEST, 0o100644, artifact_manifest(artifacts)))
+        blob_paths = []
+        for i, (path, mode, contents) in enumerate(entries):
+            blob_path = os.path.join(tmp_dir, 'blob%d' % i)
+            with open(blob_path, 'w') as f:
+                f.write(contents)
+            blob_paths.append(blob_path)
+        if not entries:
+            return
+        paths_path = os.path.join(tmp_dir, 'paths')
+        with open(paths_path, 'w') as f:
+            f.write(''.join(path + '\n' for path in blob_paths))
+        with open(paths_path) as f:
+            blobs = run(git + ['hash-object', '-w', '--stdin-paths'], stdin=f, return_stdout=True)
+        blobs = output_to_string(blobs).split()
+        index_info_path = os.path.join(tmp_dir, 'index-info')
+        with open(index_info_path, 'wb') as f:
+            for (path, mode, contents), blob in zip(entries, blobs):
+                f.write(('%o %s\t%s\0' % (mode, blob, path)).encode('utf8'))
+        with open(index_info_path, 'rb') as f:
+            run(git + ['update-index', '-z', '--index-info'], stdin=f, env=env)
+    finally:
+        rm_rf(tmp_dir)
+
+def commit_build_in_work_tree(deploy_dir, build_dir, branch, message, merged_config, deploy_refs):
+    '''Copies build output into the work tree of the local deployment
+    repository and commits it there.
+    '''
+    
+    # The local branch is (re)created at the commit returned by
+    # deploy_parent_ref: the remote branch if it exists, otherwise
+    # the local branch, otherwise master. If there is no such commit,
+    # or deployment history is being discarded, the branch starts
+    # with an empty tree initial commit.
+    start = deploy_parent_ref(branch, merged_config, deploy_refs)
+    if start is None:
+        start = git_empty_root_commit(deploy_dir)
+    git_in_dir(deploy_dir, ['checkout', '-q', '-f', '-B', branch, start])
+    
+    deploy_src = deploy_source_dir(build_dir, merged_config)
+    if merged_config.deploy_sync == 'manifest':
+        manifest_path = deploy_manifest_path(merged_config, branch)
+        manifest = load_deploy_manifest(manifest_path)
+        files = scan_tree(deploy_src)
+        # the manifest describes the work tree only if the branch was
+        # checked out at the commit it was written for, and with the same
+        # artifact settings, since artifacts are pointers in the work tree
+        start_commit = deploy_refs.commit(start) or start
+        if manifest is not None and manifest['commit'] == start_commit and \
+                manifest.get('artifacts') == artifact_settings(merged_config):
+            # the manifest does not know about files other than the ones
+            # it deployed, e.g. created by --post-cmd or an interrupted run
+            git_in_dir(deploy_dir, ['clean', '-q', '-ffdx'], cwd=deploy_dir)
+            sync_with_manifest(deploy_src, deploy_dir, manifest['files'], files)
+        else:
+            manifest = None
+    else:
+        manifest = files = None
+    if manifest is None:
+        if timings.count_bytes:
+            timings.add('bytes', tree_size(deploy_src))
+        run(['rsync', '-aI', '--exclude', '.git', deploy_src + '/', deploy_dir, '--delete'])
+    if merged_config.artifact_store:
+        write_artifact_pointers(deploy_dir, store_artifacts(deploy_src, merged_config, files))
+    # files which were not rewritten keep their index stat information
+    # and are not hashed again
+    git_in_dir(deploy_dir, ['add', '-A', '.'], cwd=deploy_dir)
+    git_in_dir(deploy_dir, ['commit', '--allow-empty', '-m', message])
+    commit = output_to_string(git_in_dir(deploy_dir, ['rev-parse', 'HEAD'],
+        return_stdout=True)).strip()
+    deploy_refs.set('refs/heads/%s' % branch, commit)
+    if files is not None:
+        # ignored files are not committed and are removed by the clean
+        # preceding the next sync, so they must be copied again then
+        ignored = git_in_dir(deploy_dir, ['ls-files', '-z', '--others', '--ignored', '--exclude-standard'],
+            cwd=deploy_dir, return_stdout=True)
+        for path in output_to_string(ignored).split('\0'):
+            files.pop(path, None)
+        save_deploy_manifest(manifest_path, commit, files, artifact_settings(merged_config))
+
+def deploy_manifest_path(merged_config, branch):
+    return os.path.join(merged_config.work_prefix, 'manifests', branch_file_name(branch) + '.json')
+
+def load_deploy_manifest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            # e.g. written by an interrupted run, do a full sync instead
+            return None
+
+def save_deploy_manifest(path, commit, files, artifacts=None):
+    dir = os.path.dirname(path)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'commit': commit, 'files': files, 'artifacts': artifacts}, f, sort_keys=True)
+    os.rename(tmp_path, path)
+
+def file_digest(path, mode):
+    digest = hashlib.sha1()
+    if stat.S_ISLNK(mode):
+        digest.update(os.readlink(path).encode('utf8'))
+    else:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def scan_tree(dir):
+    '''Returns a dict mapping relative paths of files and symlinks under
+    dir, except for .git entries, to [size, mode, sha1 of contents].
+    
+    Contents are compared by hash rather than by size and timestamp, since
+    files in different branches may have identical size and timestamp.
+    '''
+    
+    files = {}
+    for relative_path, st in walk_files(dir):
+        path = os.path.join(dir, relative_path)
+        files[relative_path] = [st.st_size, st.st_mode, file_digest(path, st.st_mode)]
+    return files
+
+def walk_files(dir):
+    '''Yields relative paths and lstat results of files and symlinks
+    under dir, except for .git entries.
+    '''
+    
+    for root, dirs, names in os.walk(dir):
+        for name in list(dirs) + names:
+            path = os.path.join(root, name)
+            if name == '.git':
+                if name in dirs:
+                    dirs.remove(name)
+                continue
+            st = os.lstat(path)
+            if stat.S_ISDIR(st.st_mode):
+                continue
+            if name in dirs:
+                # a symlink to a directory, which os.walk does not follow
+                dirs.remove(name)
+            yield os.path.relpath(path, dir), st
+
+def sync_with_manifest(src_dir, dest_dir, old_files, new_files):
+    '''Updates dest_dir, whose files are described by old_files, to have
+    the files described by new_files, copying them from src_dir.
+    
+    Only files that were added, removed or changed are touched.
+    '''
+    
+    import shutil
+    
+    for path in sorted(old_files, reverse=True):
+        if path in new_files:
+            continue
+        dest_path = os.path.join(dest_dir, path)
+        if os.path.lexists(dest_path) and not os.path.isdir(dest_path):
+            os.unlink(dest_path)
+        # remove directories left empty
+        parent = os.path.dirname(path)
+        while parent:
+            try:
+                os.rmdir(os.path.join(dest_dir, parent))
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+    
+    for path in sorted(new_files):
+        entry = new_files[path]
+        old_entry = old_files.get(path)
+        if old_entry == entry:
+            continue
+        src_path = os.path.join(src_dir, path)
+        dest_path = os.path.join(dest_dir, path)
+        if (old_entry is not None and old_entry[0] == entry[0] and old_entry[2] == entry[2]
+                and not stat.S_ISLNK(entry[1]) and not stat.S_ISLNK(old_entry[1])):
+            os.chmod(dest_path, stat.S_IMODE(entry[1]))
+            continue
+        if os.path.islink(dest_path) or os.path.isfile(dest_path):
+            os.unlink(dest_path)
+        elif os.path.isdir(dest_path):
+            # a file replacing a directory of files which were removed
+            rm_rf(dest_path)
+        else:
+            parent = os.path.dirname(dest_path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+        if stat.S_ISLNK(entry[1]):
+            os.symlink(os.readlink(src_path), dest_path)
+        else:
+            # the copy gets a current timestamp, so that git notices it changed
+            shutil.copyfile(src_path, dest_path)
+            os.chmod(dest_path, stat.S_IMODE(entry[1]))
+        if timings.count_bytes:
+            timings.add('bytes', entry[0])
+
+ARTIFACT_MANIFEST = '.buildploy-artifacts.json'
+
+def artifact_settings(merged_config):
+    '''Returns the settings which determine the files replaced by pointers,
+    or None if there is no artifact store.
+    '''
+    
+    if not merged_config.artifact_store:
+        return None
+    return [merged_config.artifact_min_size, merged_config.artifact_patterns]
+
+def artifact_pointer(digest, size):
+    return 'buildploy-artifact\nsha1 %s\nsize %d\n' % (digest, size)
+
+def store_artifacts(dir, merged_config, files=None):
+    '''Copies files under dir which match the artifact settings to the
+    artifact store, unless the store already has them, and returns a dict
+    mapping their relative paths to [size, mode, sha1 of contents].
+    
+    files, if given, is the result of scan_tree(dir) and saves hashing
+    the files again.
+    '''
+    
+    import fnmatch
+    import shutil
+    
+    if files is None:
+        entries = ((path, [st.st_size, st.st_mode, None]) for path, st in walk_files(dir))
+    else:
+        entries = files.items()
+    artifacts = {}
+    stored = 0
+    for path, entry in entries:
+        size, mode, digest = entry
+        if not stat.S_ISREG(mode) or path == ARTIFACT_MANIFEST:
+            continue
+        if merged_config.artifact_min_size is None or size < merged_config.artifact_min_size:
+            if not any(fnmatch.fnmatch(path, pattern) for pattern in merged_config.artifact_patterns):
+                continue
+        if digest is None:
+            digest = file_digest(os.path.join(dir, path), mode)
+        artifacts[path] = [size, mode, digest]
+        
+        store_path = os.path.join(merged_config.artifact_store, digest[:2], digest[2:])
+        if os.path.exists(store_path):
+            continue
+        if not os.path.isdir(os.path.dirname(store_path)):
+            try:
+                os.makedirs(os.path.dirname(store_path))
+            except OSError:
+                # created concurrently by another project
+                if not os.path.isdir(os.path.dirname(store_path)):
+                    raise
+        # artifacts appear in the store complete or not at all
+        tmp_path = '%s.tmp%d' % (store_path, os.getpid())
+        shutil.copyfile(os.path.join(dir, path), tmp_path)
+        os.rename(tmp_path, store_path)
+        stored += 1
+    if stored:
+        print('Stored %d new artifacts in %s' % (stored, merged_config.artifact_store))
+    return artifacts
+
+def artifact_manifest(artifacts):
+    manifest = {}
+    for path, (size, mode, digest) in artifacts.items():
+        manifest[path] = {'sha1': digest, 'size': size, 'mode': '%o' % git_file_mode(mode)}
+    return json.dumps(manifest, indent=2, sort_keys=True) + '\n'
+
+def git_file_mode(mode):
+    if mode & stat.S_IXUSR:
+        return 0o100755
+    else:
+        return 0o100644
+
+def write_artifact_pointers(dir, artifacts):
+    '''Replaces artifacts in dir with pointer files and writes the
+    artifact manifest, or removes it if there are no artifacts.
+    '''
+    
+    for path, (size, mode, digest) in artifacts.items():
+        pointer = artifact_pointer(digest, size)
+        full_path = os.path.join(dir, path)
+        if os.path.getsize(full_path) == len(pointer):
+            with open(full_path) as f:
+                if f.read() == pointer:
+                    continue
+        with open(full_path, 'w') as f:
+            f.write(pointer)
+    manifest_path = os.path.join(dir, ARTIFACT_MANIFEST)
+    if artifacts:
+        with open(manifest_path, 'w') as f:
+            f.write(artifact_manifest(artifacts))
     else:
-        git_in_dir(deploy_dir, ['checkout', '-b', branch])
-    git_in_dir(deploy_dir, ['branch', '-d', 'newbranch'])
+        rm_f(manifest_path)
 
-def load_config_file(path, format='auto'):
+def load_config_file(path, format='auto', cache_dir=None):
+    '''Loads a YAML or JSON configuration file.
+    
+    If cache_dir is given, parsed YAML configurations are cached there,
+    keyed on the file's path, modification time and contents, so that
+    the file does not need to be parsed again until it changes.
+    '''
+    
     if format == 'auto':
         if path.endswith('.json'):
             format = 'json'
@@ -157,9 +1756,10 @@ def load_config_file(path, format='auto'):
         import json
         load_fn = json.load
     else:
-        import yaml
-        load_fn = yaml.load
+        load_fn = load_yaml
     with open(path) as f:
+        if format == 'yaml' and cache_dir is not None:
+            return load_cached_config(path, f, load_fn, cache_dir)
         try:
             config = load_fn(f)
         except ValueError as exc:
@@ -168,6 +1768,73 @@ def load_config_file(path, format='auto'):
             raise new_exc
     return config
 
+def load_yaml(f):
+    import yaml
+    
+    # the LibYAML based loader is much faster, if PyYAML was built with it
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(f, loader)
+
+def config_cache_dir(options):
+    if options.no_config_cache:
+        return None
+    return options.config_cache_dir or default_config_cache_dir()
+
+def default_config_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'buildploy', 'config')
+
+def load_cached_config(path, f, load_fn, cache_dir):
+    '''Returns configuration parsed from the open file f, from the cache
+    if the file did not change since it was cached.
+    '''
+    
+    contents = f.read()
+    mtime = os.fstat(f.fileno()).st_mtime
+    digest = hashlib.sha1(contents.encode('utf8')).hexdigest()
+    cache_path = os.path.join(cache_dir,
+        hashlib.sha1(os.path.realpath(path).encode('utf8')).hexdigest() + '.json')
+    try:
+        with open(cache_path) as cache_f:
+            entry = json.load(cache_f)
+        if entry['mtime'] == mtime and entry['sha1'] == digest:
+            return entry['config']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    
+    config = load_fn(contents)
+    # only configurations that JSON represents exactly are cached,
+    # e.g. not those with dates or non-string keys
+    try:
+        cacheable = json.loads(json.dumps(config)) == config
+    except (TypeError, ValueError):
+        cacheable = False
+    if cacheable:
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = '%s.tmp-%d' % (cache_path, os.getpid())
+            with open(tmp_path, 'w') as cache_f:
+                json.dump({'mtime': mtime, 'sha1': digest, 'config': config}, cache_f)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError):
+            # the cache is an optimization only
+            pass
+    return config
+
+def validate_build_steps(steps):
+    names = set()
+    for step in steps:
+        for key in ['name', 'cmd', 'inputs', 'outputs']:
+            if key not in step:
+                raise ValueError('Build step is missing %s: %s' % (key, step))
+        for key in ['inputs', 'outputs']:
+            if not isinstance(step[key], list):
+                raise ValueError('%s of build step %s must be a list' % (key, step['name']))
+        if step['name'] in names:
+            raise ValueError('Duplicate build step: %s' % step['name'])
+        names.add(step['name'])
+
 class MergedConfig(object):
     def __init__(self, config, options):
         if options.branch:
@@ -177,15 +1844,26 @@ class MergedConfig(object):
         else:
             self.branches = ['master']
     
+        if config is not None:
+            self.build_steps = config.get('build_steps', [])
+        else:
+            self.build_steps = []
+        validate_build_steps(self.build_steps)
+        
         for key in ['src_repo', 'work_prefix', 'deploy_repo', 'build_cmd']:
             if getattr(options, key):
                 value = getattr(options, key)
-            elif config is not None:
+            elif config is not None and (key in config or not self.build_steps):
                 value = config[key]
+            elif key == 'build_cmd' and self.build_steps:
+                # the build consists of the build steps only
+                value = None
             else:
                 option_name = '--' + key.replace('_', '-')
                 raise ValueError('%s option or %s config value must be set' % (option_name, key))
             setattr(self, key, value)
+        # commands run in various directories under the work prefix
+        self.work_prefix = os.path.abspath(self.work_prefix)
     
         for key in ['deploy_subdir']:
             if getattr(options, key):
@@ -198,6 +1876,144 @@ class MergedConfig(object):
             
         self.work_tree = options.work_tree
         
+        if options.deploy_engine:
+            self.deploy_engine = options.deploy_engine
+        else:
+            self.deploy_engine = config.get('deploy_engine', 'worktree')
+        if self.deploy_engine not in ['worktree', 'plumbing']:
+            raise ValueError('Invalid deploy engine: %s (must be `worktree` or `plumbing`)' % self.deploy_engine)
+        
+        if options.deploy_sync:
+            self.deploy_sync = options.deploy_sync
+        else:
+            self.deploy_sync = config.get('deploy_sync', 'manifest')
+        if self.deploy_sync not in ['manifest', 'rsync']:
+            raise ValueError('Invalid deploy sync mode: %s (must be `manifest` or `rsync`)' % self.deploy_sync)
+        self.discard_deploy_history = options.discard_deploy_history
+        self.post_cmd = options.post_cmd
+        self.force = options.force
+        
+        for key in ['keep_last', 'keep_days']:
+            if getattr(options, key) is not None:
+                value = getattr(options, key)
+            else:
+                value = config.get(key, None)
+            setattr(self, key, value)
+        if self.keep_last is not None and (not isinstance(self.keep_last, int) or self.keep_last < 1):
+            raise ValueError('keep_last must be a positive integer: %s' % self.keep_last)
+        if self.keep_days is not None and self.keep_days <= 0:
+            raise ValueError('keep_days must be positive: %s' % self.keep_days)
+        if self.discard_deploy_history and (self.keep_last is not None or self.keep_days is not None):
+            raise ValueError('keep_last and keep_days cannot be used with --discard-deploy-history')
+        
+        for key, default in [('bundle_dir', None), ('bundle_history', 20)]:
+            if getattr(options, key) is not None:
+                value = getattr(options, key)
+            else:
+                value = config.get(key, default)
+            setattr(self, key, value)
+        if self.bundle_dir:
+            self.bundle_dir = os.path.abspath(self.bundle_dir)
+        if not isinstance(self.bundle_history, int) or self.bundle_history < 0:
+            raise ValueError('bundle_history must be a non-negative integer: %s' % self.bundle_history)
+        
+        for key in ['artifact_store', 'artifact_min_size']:
+            if getattr(options, key) is not None:
+                value = getattr(options, key)
+            else:
+                value = config.get(key, None)
+            setattr(self, key, value)
+        self.artifact_patterns = config.get('artifact_patterns', [])
+        if self.artifact_store:
+            self.artifact_store = os.path.abspath(self.artifact_store)
+            if self.artifact_min_size is None and not self.artifact_patterns:
+                raise ValueError('artifact_store requires artifact_min_size or artifact_patterns')
+        elif self.artifact_min_size is not None or self.artifact_patterns:
+            raise ValueError('artifact_min_size and artifact_patterns require artifact_store')
+        
+        for key in ['fetch_depth', 'fetch_filter', 'timings', 'object_cache']:
+            if getattr(options, key) is not None:
+                value = getattr(options, key)
+            else:
+                value = config.get(key, None)
+            setattr(self, key, value)
+        if self.object_cache and (self.fetch_depth or self.fetch_filter):
+            raise ValueError('object_cache cannot be used with fetch_depth or fetch_filter')
+        
+        for key, default in [('submodule_jobs', 1), ('submodule_depth', None), ('submodule_cache', False),
+                ('build_timeout', None), ('command_timeout', None), ('log_dir', None),
+                ('step_cache_size', 1024 * 1024 * 1024)]:
+            if getattr(options, key) is not None:
+                value = getattr(options, key)
+            else:
+                value = config.get(key, default)
+            setattr(self, key, value)
+        if not isinstance(self.submodule_jobs, int) or self.submodule_jobs < 1:
+            raise ValueError('submodule_jobs must be a positive integer: %s' % self.submodule_jobs)
+        
+        for key in ['max_memory', 'cpu_time', 'nice']:
+            if getattr(options, key) is not None:
+                value = getattr(options, key)
+            else:
+                value = config.get(key, None)
+            setattr(self, key, value)
+        for key in ['max_memory', 'cpu_time']:
+            value = getattr(self, key)
+            if value is not None and (not isinstance(value, int) or value < 1):
+                raise ValueError('%s must be a positive integer: %s' % (key, value))
+        if self.nice is not None and not isinstance(self.nice, int):
+            raise ValueError('nice must be an integer: %s' % self.nice)
+        
+        if options.incremental is not None:
+            self.incremental = options.incremental
+        else:
+            self.incremental = config.get('incremental', False)
+        
+        if self.incremental and self.work_tree:
+            raise ValueError('Incremental builds cannot be used with --work-tree')
+        
+        if options.materialize:
+            self.materialize = options.materialize
+        elif self.incremental:
+            self.materialize = config.get('materialize', 'worktree')
+        else:
+            self.materialize = config.get('materialize', 'rsync')
+        if self.materialize not in ['rsync', 'worktree', 'reflink']:
+            raise ValueError('Invalid materialization mode: %s (must be `rsync`, `worktree` or `reflink`)' % self.materialize)
+        if self.materialize == 'worktree' and self.work_tree:
+            raise ValueError('Using --work-tree requires rsync or reflink materialization')
+        if self.incremental and self.materialize != 'worktree':
+            raise ValueError('Incremental builds require worktree materialization')
+        
+        if options.jobs is not None:
+            self.jobs = options.jobs
+        else:
+            self.jobs = config.get('jobs', 1)
+        if not isinstance(self.jobs, int) or self.jobs < 1:
+            raise ValueError('jobs must be a positive integer: %s' % self.jobs)
+        
+        self.watch = options.watch
+        for key, default in [('watch_interval', 60), ('watch_debounce', 5), ('watch_trigger', None)]:
+            if getattr(options, key) is not None:
+                value = getattr(options, key)
+            else:
+                value = config.get(key, default)
+            setattr(self, key, value)
+        if self.watch_interval <= 0:
+            raise ValueError('watch_interval must be positive: %s' % self.watch_interval)
+        
+        if options.pipeline_push is not None:
+            self.pipeline_push = options.pipeline_push
+        else:
+            self.pipeline_push = config.get('pipeline_push', False)
+        if self.pipeline_push and self.post_cmd:
+            raise ValueError('--post-cmd cannot be used with pipelined pushes')
+        
+        # set when deploying several projects, see deploy_projects
+        self.project = None
+        self.scheduler = None
+        self.priority = config.get('priority', 0)
+        
         if options.push is not None:
             self.push = options.push
         elif 'push' in config:
@@ -206,6 +2022,7 @@ class MergedConfig(object):
             self.push = True
 
 def main():
+    import optparse
     usage = 'Usage: buildploy [options] path/to/config.{yaml|json}'
     parser = optparse.OptionParser(usage=usage)
     parser.add_option('--src-repo', dest='src_repo',
@@ -226,18 +2043,102 @@ def main():
         help='Push built tree to deployment repository (default)')
     parser.add_option('-P', '--no-push', action='store_false', dest='push',
         help='Do not push built tree to deployment repository (local build only)')
+    parser.add_option('--pipeline-push', action='store_true', dest='pipeline_push',
+        help='Push each branch in the background as soon as it is committed')
     parser.add_option('--yaml-config', action='store_true', dest='yaml_config',
         help='Interpret configuration as YAML')
     parser.add_option('--json-config', action='store_true', dest='json_config',
         help='Interpret configuration as JSON')
+    parser.add_option('--config-cache-dir', dest='config_cache_dir',
+        help='Cache parsed YAML configuration in this directory (default ~/.cache/buildploy/config)')
+    parser.add_option('--no-config-cache', action='store_true', dest='no_config_cache',
+        help='Always parse YAML configuration files')
     parser.add_option('--discard-deploy-history', action='store_true', dest='discard_deploy_history',
         help='Discard history of branches being transformed in deployment repository')
+    parser.add_option('--artifact-store', dest='artifact_store',
+        help='Keep large build artifacts in this directory, committing pointer files instead')
+    parser.add_option('--artifact-min-size', type='int', dest='artifact_min_size',
+        help='Move files of at least this many bytes to the artifact store')
+    parser.add_option('--bundle-dir', dest='bundle_dir',
+        help='Write full and incremental git bundles of deploy branches and an index to this directory')
+    parser.add_option('--bundle-history', type='int', dest='bundle_history',
+        help='Keep incremental bundles of this many previous deploys of each branch (default 20)')
+    parser.add_option('--keep-last', type='int', dest='keep_last',
+        help='Keep only this many deploy commits of each branch, rewriting older history away')
+    parser.add_option('--keep-days', type='float', dest='keep_days',
+        help='Keep only deploy commits of each branch made in this many last days')
     parser.add_option('-c', '--post-cmd', dest='post_cmd',
         help='Command to run in deployment directory after build completes')
+    parser.add_option('--deploy-engine', dest='deploy_engine',
+        help='How build output is committed: worktree (default) or plumbing')
+    parser.add_option('--deploy-sync', dest='deploy_sync',
+        help='How the worktree engine updates the deploy work tree: manifest (default) or rsync')
+    parser.add_option('--fetch-depth', type='int', dest='fetch_depth',
+        help='Fetch only this many commits of history of each branch')
+    parser.add_option('--fetch-filter', dest='fetch_filter',
+        help='Make partial clones using this object filter, e.g. blob:none')
+    parser.add_option('--submodule-jobs', type='int', dest='submodule_jobs',
+        help='Fetch up to this many submodules in parallel')
+    parser.add_option('--submodule-depth', type='int', dest='submodule_depth',
+        help='Fetch only this many commits of history of each submodule')
+    parser.add_option('--submodule-cache', action='store_true', dest='submodule_cache',
+        help='Keep submodule objects in a cache under the work prefix shared by all checkouts')
+    parser.add_option('--object-cache', dest='object_cache',
+        help='Share objects of source and deployment repositories through this repository')
+    parser.add_option('--build-timeout', type='float', dest='build_timeout',
+        help='Fail builds running longer than this many seconds')
+    parser.add_option('--command-timeout', type='float', dest='command_timeout',
+        help='Fail git and other commands running longer than this many seconds')
+    parser.add_option('--max-memory', type='int', dest='max_memory',
+        help='Limit data segment size of each build process to this many bytes')
+    parser.add_option('--cpu-time', type='int', dest='cpu_time',
+        help='Limit CPU time of each build process to this many seconds')
+    parser.add_option('--nice', type='int', dest='nice',
+        help='Run builds with this niceness')
+    parser.add_option('--step-cache-size', type='int', dest='step_cache_size',
+        help='Keep at most this many bytes of build step outputs in the step cache (default 1 GiB)')
+    parser.add_option('--log-dir', dest='log_dir',
+        help='Write output of the build of each branch to a log file in this directory')
+    parser.add_option('--materialize', dest='materialize',
+        help='How sources are prepared for building: rsync (default), worktree or reflink')
+    parser.add_option('--incremental', action='store_true', dest='incremental',
+        help='Keep build products of each branch between runs and update only changed sources')
+    parser.add_option('--timings', dest='timings',
+        help='Write per-phase timings of the run to this file as JSON and print a summary')
+    parser.add_option('--force', action='store_true', dest='force',
+        help='Build branches even if their source commit has already been deployed')
+    parser.add_option('-j', '--jobs', type='int', dest='jobs',
+        help='Build up to this many branches in parallel, each in its own build directory')
+    parser.add_option('--watch', action='store_true', dest='watch',
+        help='Keep running, deploying branches whenever they move in the source repository')
+    parser.add_option('--watch-interval', type='float', dest='watch_interval',
+        help='Poll the source repository every this many seconds (default 60)')
+    parser.add_option('--watch-debounce', type='float', dest='watch_debounce',
+        help='Wait until branches have not moved for this many seconds before deploying (default 5)')
+    parser.add_option('--watch-trigger', dest='watch_trigger',
+        help='Poll immediately whenever this FIFO is written to')
+    parser.add_option('--projects', dest='projects',
+        help='Deploy all projects configured in this directory or projects file')
+    parser.add_option('--network-jobs', type='int', dest='network_jobs',
+        help='With --projects, run up to this many fetches and pushes at a time (default 4)')
     options, args = parser.parse_args()
     
     if options.yaml_config and options.json_config:
         raise ValueError('--yaml-config and --json-config cannot be both specified')
+    
+    if options.projects:
+        if args:
+            raise ValueError('--projects cannot be used with a configuration file')
+        if options.watch:
+            raise ValueError('--projects cannot be used with --watch')
+        if options.timings:
+            timings.count_bytes = True
+        try:
+            deploy_projects(options)
+        finally:
+            if options.timings:
+                write_timings(options.timings)
+        return
 
     if len(args) > 1:
         parser.print_help()
@@ -253,114 +2154,575 @@ def main():
     else:
         format = None
     if format is not None:
-        config = load_config_file(config_file, format)
+        config = load_config_file(config_file, format, config_cache_dir(options))
     else:
         config = {}
     
     merged_config = MergedConfig(config, options)
     del config
     
+    use_command_timeout(merged_config)
+    if merged_config.timings:
+        timings.count_bytes = True
+    if merged_config.watch:
+        watch(merged_config)
+        return
+    try:
+        deploy(merged_config)
+    finally:
+        if merged_config.timings:
+            write_timings(merged_config.timings)
+
+def write_timings(path):
+    with open(path, 'w') as f:
+        json.dump(timings.report(), f, indent=2, sort_keys=True)
+    print(timings.summary())
+
+def deploy(merged_config, selected=None):
+    '''Builds configured branches, or only the selected ones if given,
+    and commits and pushes the results to the deployment repository.
+    '''
+    
+    if selected is None:
+        selected = merged_config.branches
+    
     if merged_config.work_tree:
-        if len(merged_config.branches) > 1:
+        if len(selected) > 1:
             raise ValueError('Using --work-tree requires specifying --branch if multiple branches are configured')
         if merged_config.src_repo[0] != '/':
             # XXX allow file:// urls also
             raise ValueError('Using --work-tree requires a filesystem path for src repo')
     
+    if merged_config.deploy_engine == 'plumbing' and merged_config.post_cmd:
+        raise ValueError('--post-cmd requires the worktree deploy engine')
+    
     if not os.path.exists(merged_config.work_prefix):
         os.mkdir(merged_config.work_prefix)
     
-    if not options.work_tree:
-        local_src = os.path.join(merged_config.work_prefix, 'src')
-        if not os.path.exists(local_src):
-            run(['git', 'init', local_src])
-            git_in_dir(local_src, ['remote', 'add', 'src', merged_config.src_repo, '-f'])
-        else:
-            fetch_branches = ['src/' + branch for branch in merged_config.branches]
-            git_in_dir(local_src, ['fetch', 'src'])
-
+    local_src = os.path.join(merged_config.work_prefix, 'src')
     build_dir = os.path.join(merged_config.work_prefix, 'build')
     if not os.path.exists(build_dir):
         os.mkdir(build_dir)
-
     deploy_dir = os.path.join(merged_config.work_prefix, 'deploy')
-    if not os.path.exists(deploy_dir):
-        run(['git', 'init', deploy_dir])
-        git_in_dir(deploy_dir, ['remote', 'add', 'deploy', merged_config.deploy_repo, '-f'])
-    git_in_dir(deploy_dir, ['fetch', 'deploy'])
-    local_branches = git_list_local_branches(deploy_dir)
-    remote_branches = git_list_remote_branches(deploy_dir)
-    for branch in merged_config.branches:
-        if options.work_tree:
-            copy(merged_config.src_repo, build_dir)
+    
+    with job_slot(merged_config, 'network'):
+        with timings.phase('fetch', project=merged_config.project):
+            if not merged_config.work_tree:
+                init_repo(local_src, 'src', merged_config.src_repo)
+                fetch_branches(local_src, 'src', selected, merged_config)
+            
+            init_repo(deploy_dir, 'deploy', merged_config.deploy_repo)
+            # configured branches may not exist in the deployment repository yet,
+            # and master is needed to start new branches from
+            wanted = list(selected)
+            if 'master' not in wanted:
+                wanted.append('master')
+            fetch_branches(deploy_dir, 'deploy',
+                git_list_remote_heads(deploy_dir, 'deploy', wanted), merged_config)
+    deploy_refs = RefStore(deploy_dir)
+    
+    config_hash = build_config_hash(merged_config)
+    branches = list(selected)
+    if merged_config.work_tree:
+        source_commits = {}
+        unchanged = []
+        unpushed = []
+    else:
+        with timings.phase('refs', project=merged_config.project):
+            src_refs = RefStore(local_src, ['refs/remotes/src'])
+            source_commits = {}
+            source_trees = {}
+            for branch in branches:
+                refname = 'refs/remotes/src/%s' % branch
+                if not src_refs.exists(refname):
+                    raise ValueError('Branch %s does not exist in source repository' % branch)
+                source_commits[branch] = src_refs.commit(refname)
+                source_trees[branch] = src_refs.tree(refname)
+            if merged_config.force or merged_config.discard_deploy_history:
+                unchanged = []
+                unpushed = []
+            else:
+                unchanged, unpushed = find_unchanged_branches(deploy_dir, branches,
+                    source_commits, config_hash, deploy_refs)
+    for branch in unchanged:
+        print('Skipping %s: source commit %s is already deployed' % (branch, source_commits[branch]))
+        branches.remove(branch)
+    
+    # branches with identical source trees are built once, and the result
+    # is committed to each of them
+    if merged_config.work_tree:
+        groups = [[branch] for branch in branches]
+    else:
+        groups = group_branches_by_tree(branches, source_trees)
+    
+    # branches whose history retention rewrote are force pushed
+    rewritten = set()
+    if merged_config.push and merged_config.pipeline_push:
+        # each branch is pushed in the background as soon as it is
+        # committed, while the following branches are being built
+        pusher = BackgroundPusher(deploy_dir, merged_config, rewritten)
+        for branch in unpushed:
+            pusher.push(branch)
+    else:
+        pusher = None
+    push_failed = {}
+    try:
+        if merged_config.jobs > 1 and not merged_config.work_tree:
+            leaders = [group[0] for group in groups]
+            # Branches are committed one at a time, in the order a sequential
+            # run would commit them: each group as soon as its build and the
+            # builds of all groups before it finished, so that its branches
+            # can be pushed while the following groups are still building.
+            uncommitted = list(groups)
+            finished = {}
+            commit_lock = threading.Lock()
+            commit_errors = []
+            
+            def commit_finished(leader, group_build_dir):
+                with commit_lock:
+                    finished[leader] = group_build_dir
+                    while uncommitted and uncommitted[0][0] in finished and not commit_errors:
+                        group = uncommitted.pop(0)
+                        group_build_dir = finished[group[0]]
+                        if group_build_dir is None:
+                            continue
+                        try:
+                            for branch in group:
+                                message = build_commit_message(source_commits[branch], config_hash)
+                                with timings.phase('commit', branch, merged_config.project):
+                                    if commit_build(deploy_dir, group_build_dir, branch, message,
+                                            merged_config, deploy_refs):
+                                        rewritten.add(branch)
+                                if pusher is not None:
+                                    pusher.push(branch)
+                        except Exception as e:
+                            # raised once the other builds finished
+                            commit_errors.append(e)
+            
+            built, failed = build_branches_in_parallel(local_src, leaders, merged_config,
+                commit_finished)
+            if commit_errors:
+                raise commit_errors[0]
+            for group in groups:
+                if group[0] in failed:
+                    for branch in group[1:]:
+                        failed[branch] = failed[group[0]]
         else:
-            checkout(local_src, build_dir, branch)
-        build(build_dir, branch, merged_config)
+            failed = {}
+            for group in groups:
+                leader = group[0]
+                with timings.phase('checkout', leader, merged_config.project):
+                    if merged_config.work_tree:
+                        copy(merged_config.src_repo, build_dir, merged_config)
+                        group_build_dir = build_dir
+                    else:
+                        group_build_dir = checkout(local_src, build_dir, leader, merged_config)
+                with job_slot(merged_config, 'build'):
+                    with timings.phase('build', leader, merged_config.project):
+                        build(group_build_dir, leader, merged_config)
+                for branch in group:
+                    message = build_commit_message(source_commits.get(branch), config_hash)
+                    with timings.phase('commit', branch, merged_config.project):
+                        if commit_build(deploy_dir, group_build_dir, branch, message, merged_config, deploy_refs):
+                            rewritten.add(branch)
+                    if pusher is not None:
+                        pusher.push(branch)
+    finally:
+        if pusher is not None:
+            push_failed = pusher.finish()
+    if merged_config.post_cmd:
+        with timings.phase('post_cmd', project=merged_config.project):
+            run_in_dir(deploy_dir, merged_config.post_cmd)
+
+    # unchanged branches are pushed only if a previous run has not
+    # pushed them yet
+    push_branches = [branch for branch in selected
+        if branch not in failed and (branch not in unchanged or branch in unpushed)]
+    if merged_config.push and pusher is None and push_branches:
+        with job_slot(merged_config, 'network'):
+            with timings.phase('push', project=merged_config.project):
+                git_in_dir(deploy_dir, push_command(push_branches, merged_config, rewritten))
+    if merged_config.keep_last is not None or merged_config.keep_days is not None:
+        with timings.phase('gc', project=merged_config.project):
+            compact_deploy_repo(deploy_dir)
+    if merged_config.bundle_dir:
+        with timings.phase('bundle', project=merged_config.project):
+            write_bundles(deploy_dir, [branch for branch in selected
+                if branch not in failed and branch not in push_failed], merged_config, deploy_refs)
+    
+    messages = []
+    if failed:
+        messages.append('Failed to build branches: %s' % ', '.join(sorted(failed)))
+    if push_failed:
+        messages.append('Failed to push branches: %s' % ', '.join(sorted(push_failed)))
+        raise PushFailure('; '.join(messages))
+    if failed:
+        raise BuildFailure(messages[0])
+
+BUNDLE_INDEX = 'index.json'
+
+def write_bundles(deploy_dir, branches, merged_config, deploy_refs):
+    '''Writes git bundles of the deploy branches to bundle_dir, so that
+    servers can fetch deploys as static files.
+    
+    For every branch there is a full bundle of its latest deploy commit,
+    and incremental bundles from each previous deploy commit to the one
+    following it, for up to bundle_history previous deploys. index.json
+    lists them and is replaced only after all bundles were written.
+    '''
+    
+    bundle_dir = merged_config.bundle_dir
+    index_path = os.path.join(bundle_dir, BUNDLE_INDEX)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    else:
+        index = {}
+    
+    changed = False
+    obsolete = []
+    for branch in branches:
+        refname = 'refs/heads/%s' % branch
+        commit = deploy_refs.commit(refname)
+        entry = index.get(branch)
+        if commit is None or (entry is not None and entry['commit'] == commit):
+            continue
+        branch_dir = branch_file_name(branch)
+        if not os.path.exists(os.path.join(bundle_dir, branch_dir)):
+            os.makedirs(os.path.join(bundle_dir, branch_dir))
         
-        # Initial branch checkout:
-        # 1. Branch exists in local deploy repo - check it out
-        # 1.1. Branch also exists in remote deploy repo - hard reset to remote
-        # 1.2. Branch does not exist in remote - do nothing, will create
-        #      when pushing
-        # 2. Branch does not exist in local deploy repo:
-        # 2.1. Branch exists in remote deploy repo - create a new local branch
-        #      tracking the corresponding remote branch
-        # 2.2. Branch does not exist in remote:
-        #      We can start with current master or an empty tree.
-        #      Let's start with master if it exists, otherwise an empty tree.
-        # XXX test all paths
-        already_reset = False
-        if branch in local_branches:
-            git_in_dir(deploy_dir, ['checkout', branch])
-            if 'deploy/%s' % branch in remote_branches:
-                git_in_dir(deploy_dir, ['reset', '--hard', 'deploy/%s' % branch])
+        if entry is None:
+            entry = {'incremental': []}
         else:
-            if 'deploy/%s' % branch in remote_branches:
-                git_in_dir(deploy_dir, ['checkout', '-b', branch, '--track', 'deploy/%s' % branch])
+            obsolete.append(entry['full'])
+            # after history was rewritten, e.g. by retention, clients
+            # can only start over from the full bundle
+            if git_in_dir(deploy_dir, ['merge-base', '--is-ancestor', entry['commit'], commit],
+                    return_code=True) == 0:
+                path = '%s/%s-%s.bundle' % (branch_dir, entry['commit'], commit)
+                create_bundle(deploy_dir, path, bundle_dir, ['^' + entry['commit'], refname])
+                entry['incremental'].append({'from': entry['commit'], 'to': commit, 'bundle': path})
             else:
-                # no local and no remote branch
-                done = False
-                if branch != 'master':
-                    # attempt to copy from master
-                    have_master = False
-                    if 'master' in local_branches:
-                        git_in_dir(deploy_dir, ['checkout', 'master'])
-                        if 'master' in remote_branches:
-                            git_in_dir(deploy_dir, ['reset', '--hard', 'deploy/master'])
-                        have_master = True
-                    elif 'master' in remote_branches:
-                        git_in_dir(deploy_dir, ['checkout', '-b', 'master', '--track', 'deploy/master'])
-                        have_master = True
-                    if have_master:
-                        # copies master
-                        git_in_dir(deploy_dir, ['checkout', '-b', branch])
-                        done = True
-                if not done:
-                    # no master to copy from or we are dealing with master
-                    # branch itself; create an empty tree initial commit
-                    git_reset_to_empty_tree(deploy_dir, branch)
-                    already_reset = True
+                obsolete.extend(bundle['bundle'] for bundle in entry['incremental'])
+                entry['incremental'] = []
+        excess = len(entry['incremental']) - merged_config.bundle_history
+        if excess > 0:
+            obsolete.extend(bundle['bundle'] for bundle in entry['incremental'][:excess])
+            entry['incremental'] = entry['incremental'][excess:]
+        entry['full'] = '%s/%s.bundle' % (branch_dir, commit)
+        create_bundle(deploy_dir, entry['full'], bundle_dir, [refname])
+        entry['commit'] = commit
+        index[branch] = entry
+        changed = True
+    
+    if not changed:
+        return
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, index_path)
+    # clients reading the previous index may still fetch these
+    # for a moment, so they are removed last
+    for path in obsolete:
+        rm_f(os.path.join(bundle_dir, path))
+
+def create_bundle(deploy_dir, path, bundle_dir, revs):
+    tmp_path = os.path.join(bundle_dir, path + '.tmp')
+    git_in_dir(deploy_dir, ['bundle', 'create', tmp_path] + revs)
+    os.rename(tmp_path, os.path.join(bundle_dir, path))
+
+def push_command(branches, merged_config, rewritten=()):
+    '''Returns arguments of the push of branches, forcing the update of
+    branches in rewritten, which no longer contain the deployed commits.
+    '''
+    
+    cmd = ['push', 'deploy']
+    for branch in branches:
+        if branch in rewritten:
+            cmd.append('+' + branch)
+        else:
+            cmd.append(branch)
+    if merged_config.discard_deploy_history:
+        cmd += ['-f']
+    return cmd
+
+class BackgroundPusher(object):
+    '''Pushes branches of the local deployment repository from a background
+    thread, in the order they were queued.
+    
+    Branches queued while a push is running are pushed together by the
+    next push. If that fails, they are pushed one at a time, so that
+    failures are attributed to the right branches.
+    '''
+    
+    def __init__(self, deploy_dir, merged_config, rewritten=()):
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+        
+        self.deploy_dir = deploy_dir
+        self.merged_config = merged_config
+        # branches are added before they are queued
+        self.rewritten = rewritten
+        self.queue = queue.Queue()
+        self.failed = {}
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def push(self, branch):
+        self.queue.put(branch)
+    
+    def finish(self):
+        '''Waits for queued branches to be pushed and returns a dictionary
+        mapping branches that failed to push to formatted tracebacks.
+        '''
         
-        if options.discard_deploy_history and not already_reset:
-            git_reset_to_empty_tree(deploy_dir, branch)
+        self.queue.put(None)
+        self.thread.join()
+        return self.failed
+    
+    def run(self):
+        use_command_timeout(self.merged_config)
+        finished = False
+        while not finished:
+            branches = [self.queue.get()]
+            # this is the only consumer, queued items cannot disappear
+            while not self.queue.empty():
+                branches.append(self.queue.get())
+            if None in branches:
+                branches.remove(None)
+                finished = True
+            if not branches:
+                continue
+            if self.push_branches(branches) or len(branches) == 1:
+                continue
+            for branch in branches:
+                self.push_branches([branch])
+    
+    def push_branches(self, branches):
+        import traceback
         
-        if merged_config.deploy_subdir is not None:
-            deploy_src = os.path.join(build_dir, merged_config.deploy_subdir)
+        merged_config = self.merged_config
+        try:
+            with job_slot(merged_config, 'network'):
+                with timings.phase('push', ', '.join(branches), merged_config.project):
+                    git_in_dir(self.deploy_dir, push_command(branches, merged_config, self.rewritten))
+        except Exception:
+            if len(branches) == 1:
+                msg = traceback.format_exc()
+                sys.stderr.write('Push of branch %s failed:\n%s' % (branches[0], msg))
+                sys.stderr.flush()
+                self.failed[branches[0]] = msg
+            return False
+        return True
+
+def load_projects(path, options):
+    '''Returns merged configurations of the projects configured in path,
+    which is either a directory of configuration files or a projects
+    file listing them.
+    
+    Entries of the projects file are paths of configuration files,
+    relative to the projects file, or mappings with a `config` path and
+    optionally `name` and `priority`.
+    '''
+    
+    import optparse
+    
+    if os.path.isdir(path):
+        entries = [{'config': os.path.join(path, name)} for name in sorted(os.listdir(path))
+            if name[0] != '.' and os.path.splitext(name)[1] in ['.yaml', '.yml', '.json']]
+    else:
+        entries = []
+        for entry in (load_config_file(path, cache_dir=config_cache_dir(options)) or {}).get('projects', []):
+            if not isinstance(entry, dict):
+                entry = {'config': entry}
+            entry = dict(entry)
+            entry['config'] = os.path.join(os.path.dirname(path), entry['config'])
+            entries.append(entry)
+    
+    # the job limit and timings apply to the whole run
+    project_options = optparse.Values(options.__dict__)
+    project_options.jobs = None
+    project_options.timings = None
+    projects = []
+    names = set()
+    for entry in entries:
+        config = load_config_file(entry['config'], cache_dir=config_cache_dir(options)) or {}
+        merged_config = MergedConfig(config, project_options)
+        merged_config.project = entry.get('name') or config.get('name') or \
+            os.path.splitext(os.path.basename(entry['config']))[0]
+        if merged_config.project in names:
+            raise ValueError('Duplicate project name: %s' % merged_config.project)
+        names.add(merged_config.project)
+        if 'priority' in entry:
+            merged_config.priority = entry['priority']
+        projects.append(merged_config)
+    return projects
+
+def deploy_projects(options):
+    '''Deploys all projects configured in options.projects at the same
+    time, sharing build and network job slots between them, and prints
+    the status of each project at the end.
+    '''
+    
+    import traceback
+    
+    projects = load_projects(options.projects, options)
+    if not projects:
+        raise ValueError('No projects configured in %s' % options.projects)
+    scheduler = Scheduler({
+        'build': options.jobs or 1,
+        'network': options.network_jobs or 4,
+    })
+    results = {}
+    lock = threading.Lock()
+    
+    def deploy_project(merged_config):
+        use_command_timeout(merged_config)
+        start = time.time()
+        try:
+            deploy(merged_config)
+        except Exception as exc:
+            sys.stderr.write('Deploying project %s failed:\n%s' % (
+                merged_config.project, traceback.format_exc()))
+            sys.stderr.flush()
+            status = 'failed: %s' % exc
         else:
-            deploy_src = build_dir
-        run(['rsync', '-aI', '--exclude', '.git', deploy_src + '/', deploy_dir, '--delete'])
-        git_in_dir(deploy_dir, ['add', '-u'])
-        git_in_dir(deploy_dir, ['add', '.'])
-        git_in_dir(deploy_dir, ['commit', '--allow-empty', '-m', 'Built at %s' % time.strftime('%a %b %d %H:%M:%S %Y %z')])
-    if options.post_cmd:
-        run_in_dir(deploy_dir, options.post_cmd)
-
-    push = merged_config.push
-    if push:
-        cmd = ['push', 'deploy'] + merged_config.branches
-        if options.discard_deploy_history:
-            cmd += ['-f']
-        git_in_dir(deploy_dir, cmd)
+            status = 'ok'
+        with lock:
+            results[merged_config.project] = (status, time.time() - start)
+    
+    threads = []
+    for merged_config in projects:
+        merged_config.scheduler = scheduler
+        thread = threading.Thread(target=deploy_project, args=(merged_config,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    
+    print('Projects:')
+    for merged_config in projects:
+        status, seconds = results[merged_config.project]
+        print('  %-20s %8.2fs %s' % (merged_config.project, seconds, status))
+    failed = [merged_config.project for merged_config in projects
+        if results[merged_config.project][0] != 'ok']
+    if failed:
+        raise BuildFailure('Failed to deploy projects: %s' % ', '.join(failed))
+
+class WatchTrigger(object):
+    '''A FIFO which, when written to, makes the watcher poll immediately.
+    
+    The FIFO is also opened for writing by the watcher itself, so that
+    it does not report end of file after each writer closes it.
+    '''
+    
+    def __init__(self, path):
+        if not os.path.exists(path):
+            os.mkfifo(path)
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.keepalive_fd = os.open(path, os.O_WRONLY)
+    
+    def wait(self, timeout):
+        '''Waits until the FIFO is written to or timeout seconds pass.
+        '''
+        
+        import select
+        
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            # drain everything written so far, so that several
+            # triggers in a row result in a single poll
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except OSError:
+                pass
+
+def watch(merged_config):
+    '''Runs until interrupted, deploying configured branches whenever
+    their tips in the source repository move.
+    
+    Remote heads are polled with ls-remote every watch_interval seconds,
+    or right away when the watch_trigger FIFO is written to, and compared
+    to the heads deployed by this process. Once a change is seen polling
+    continues every watch_debounce seconds until the heads stop moving,
+    so that a series of pushes results in a single deployment. Only the
+    moved branches are fetched, built and pushed.
+    '''
+    
+    if merged_config.work_tree:
+        raise ValueError('--watch cannot be used with --work-tree')
+    
+    if not os.path.exists(merged_config.work_prefix):
+        os.mkdir(merged_config.work_prefix)
+    local_src = os.path.join(merged_config.work_prefix, 'src')
+    init_repo(local_src, 'src', merged_config.src_repo)
+    
+    if merged_config.watch_trigger:
+        trigger = WatchTrigger(merged_config.watch_trigger)
+    else:
+        trigger = None
+    
+    def poll():
+        return git_remote_heads(local_src, 'src', merged_config.branches)
+    
+    deployed = {}
+    while True:
+        try:
+            heads = poll()
+            moved = [branch for branch in merged_config.branches
+                if branch in heads and heads[branch] != deployed.get(branch)]
+            if moved and merged_config.watch_debounce:
+                while True:
+                    time.sleep(merged_config.watch_debounce)
+                    latest = poll()
+                    if latest == heads:
+                        break
+                    heads = latest
+                moved = [branch for branch in merged_config.branches
+                    if branch in heads and heads[branch] != deployed.get(branch)]
+            for branch in list(deployed):
+                if branch not in heads:
+                    # deploy the branch again if it is recreated
+                    del deployed[branch]
+        except subprocess.CalledProcessError as exc:
+            print('Failed to poll source repository: %s' % exc)
+            moved = []
+        
+        if moved:
+            print('Deploying %s' % ', '.join(moved))
+            sys.stdout.flush()
+            try:
+                deploy(merged_config, moved)
+            except PushFailure as exc:
+                # pushes are retried on the next poll
+                print(str(exc))
+                succeeded = False
+            except BuildFailure as exc:
+                # failed builds are retried once their branches move again
+                print(str(exc))
+                succeeded = True
+            except subprocess.CalledProcessError as exc:
+                # e.g. fetching or pushing failed, retry on the next poll
+                print('Deployment failed: %s' % exc)
+                succeeded = False
+            else:
+                succeeded = True
+            if succeeded:
+                for branch in moved:
+                    deployed[branch] = heads[branch]
+            if merged_config.timings:
+                write_timings(merged_config.timings)
+                timings.reset()
+        sys.stdout.flush()
+        
+        if trigger:
+            trigger.wait(merged_config.watch_interval)
+        else:
+            time.sleep(merged_config.watch_interval)
 
 if __name__ == '__main__':
     main()
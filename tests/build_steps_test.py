@@ -0,0 +1,86 @@
+import os
+import os.path
+import threading
+import buildploy
+import unittest
+
+class BuildStepsTest(unittest.TestCase):
+    def setUp(self):
+        super(BuildStepsTest, self).setUp()
+        
+        test_tmp = os.environ.get('TESTS_TMP') or os.path.join(os.path.dirname(__file__), 'tmp')
+        self.test_dir = os.path.join(test_tmp, 'build_steps')
+        buildploy.rm_rf(self.test_dir)
+        self.cache_dir = os.path.join(self.test_dir, 'step-cache')
+        self.build_dir = os.path.join(self.test_dir, 'build')
+        os.makedirs(os.path.join(self.build_dir, 'out'))
+        self.step = {'name': 'step', 'cmd': 'true', 'inputs': [], 'outputs': ['out/file']}
+    
+    def save(self, name, content, mtime):
+        with open(os.path.join(self.build_dir, 'out/file'), 'w') as f:
+            f.write(content)
+        entry_dir = os.path.join(self.cache_dir, name)
+        buildploy.save_step_outputs(entry_dir, self.build_dir, self.step)
+        os.utime(entry_dir, (mtime, mtime))
+        return entry_dir
+    
+    def test_key(self):
+        entries = [('docs', 'a' * 40), ('docs/intro.md', 'b' * 40), ('src', 'c' * 40)]
+        step = dict(self.step, inputs=['docs/'])
+        key = buildploy.build_step_key(step, entries)
+        changed = [('docs', 'd' * 40), ('docs/intro.md', 'b' * 40), ('src', 'e' * 40)]
+        self.assertNotEqual(key, buildploy.build_step_key(step, changed))
+        unrelated = [('docs', 'a' * 40), ('docs/intro.md', 'b' * 40), ('src', 'e' * 40)]
+        self.assertEqual(key, buildploy.build_step_key(step, unrelated))
+    
+    def test_restore(self):
+        entry_dir = self.save('entry', 'cached\n', 1000)
+        os.unlink(os.path.join(self.build_dir, 'out/file'))
+        buildploy.restore_step_outputs(entry_dir, self.build_dir, self.step)
+        with open(os.path.join(self.build_dir, 'out/file')) as f:
+            self.assertEqual('cached\n', f.read())
+    
+    def test_evict_least_recently_used(self):
+        oldest = self.save('oldest', 'x' * 100, 1000)
+        used = self.save('used', 'x' * 100, 3000)
+        newest = self.save('newest', 'x' * 100, 2000)
+        buildploy.evict_step_cache(self.cache_dir, 250, newest)
+        self.assertFalse(os.path.exists(oldest))
+        self.assertTrue(os.path.exists(used))
+        self.assertTrue(os.path.exists(newest))
+        
+        # the entry just saved is kept even if it alone exceeds the limit
+        buildploy.evict_step_cache(self.cache_dir, 50, newest)
+        self.assertEqual(['newest'], os.listdir(self.cache_dir))
+    
+    def test_concurrent_save(self):
+        # builds of several branches run in threads of one process
+        for i in range(200):
+            with open(os.path.join(self.build_dir, 'out/file%d' % i), 'w') as f:
+                f.write('%d\n' % i)
+        step = dict(self.step, outputs=['out'])
+        entry_dir = os.path.join(self.cache_dir, 'entry')
+        failed = []
+        
+        def save():
+            try:
+                buildploy.save_step_outputs(entry_dir, self.build_dir, step)
+            except Exception:
+                failed.append(True)
+        
+        threads = [threading.Thread(target=save) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], failed)
+        self.assertEqual(['entry'], os.listdir(self.cache_dir))
+        assert os.path.exists(os.path.join(entry_dir, 'outputs/out/file199'))
+    
+    def test_missing_output(self):
+        with self.assertRaises(buildploy.BuildFailure):
+            buildploy.save_step_outputs(os.path.join(self.cache_dir, 'entry'),
+                self.test_dir, self.step)
+
+if __name__ == '__main__':
+    unittest.main()
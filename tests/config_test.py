@@ -1,4 +1,5 @@
 import os.path
+import shutil
 import buildploy
 import unittest
 import mock
@@ -42,8 +43,25 @@ class ConfigTest(unittest.TestCase):
     def test_json(self):
         self.check('json_config.json')
     
-    def check(self, config_file_path):
-        config = buildploy.load_config_file(os.path.join(self.fixtures_dir, config_file_path))
+    def test_cache(self):
+        test_tmp = os.environ.get('TESTS_TMP') or os.path.join(os.path.dirname(__file__), 'tmp')
+        cache_dir = os.path.join(test_tmp, 'config_cache')
+        buildploy.rm_rf(cache_dir)
+        config_path = os.path.join(test_tmp, 'cached_config.yml')
+        shutil.copy(os.path.join(self.fixtures_dir, 'yaml_config.yml'), config_path)
+        self.check(config_path, cache_dir)
+        
+        with mock.patch('yaml.load', disabled_yaml):
+            self.check(config_path, cache_dir)
+            
+            # a changed file is parsed again
+            with open(config_path, 'a') as f:
+                f.write('\n')
+            self.assertRaises(YamlDisabled, self.check, config_path, cache_dir)
+    
+    def check(self, config_file_path, cache_dir=None):
+        config = buildploy.load_config_file(os.path.join(self.fixtures_dir, config_file_path),
+            cache_dir=cache_dir)
         
         expected = {
             'src_repo': '/path/to/src/repo',
@@ -0,0 +1,57 @@
+import os
+import os.path
+import buildploy
+import unittest
+
+def write(path, content):
+    dir = os.path.dirname(path)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    with open(path, 'w') as f:
+        f.write(content)
+
+class DeploySyncTest(unittest.TestCase):
+    def setUp(self):
+        super(DeploySyncTest, self).setUp()
+        
+        test_tmp = os.environ.get('TESTS_TMP') or os.path.join(os.path.dirname(__file__), 'tmp')
+        self.test_dir = os.path.join(test_tmp, 'deploy_sync')
+        buildploy.rm_rf(self.test_dir)
+        self.old = os.path.join(self.test_dir, 'old')
+        self.new = os.path.join(self.test_dir, 'new')
+        self.dest = os.path.join(self.test_dir, 'dest')
+    
+    def sync(self):
+        old_files = buildploy.scan_tree(self.old)
+        buildploy.rm_rf(self.dest)
+        os.rename(self.old, self.dest)
+        new_files = buildploy.scan_tree(self.new)
+        buildploy.sync_with_manifest(self.new, self.dest, old_files, new_files)
+        self.assertEqual(new_files, buildploy.scan_tree(self.dest))
+    
+    def test_changed_and_removed_files(self):
+        write(os.path.join(self.old, 'keep'), 'keep')
+        write(os.path.join(self.old, 'change'), 'old')
+        write(os.path.join(self.old, 'dir/remove'), 'remove')
+        write(os.path.join(self.new, 'keep'), 'keep')
+        write(os.path.join(self.new, 'change'), 'new')
+        os.symlink('keep', os.path.join(self.new, 'link'))
+        self.sync()
+        assert not os.path.exists(os.path.join(self.dest, 'dir'))
+        self.assertEqual('keep', os.readlink(os.path.join(self.dest, 'link')))
+    
+    def test_file_replaced_by_directory(self):
+        write(os.path.join(self.old, 'a'), 'file')
+        write(os.path.join(self.old, 'b/c'), 'file')
+        write(os.path.join(self.new, 'a/c'), 'file')
+        write(os.path.join(self.new, 'b'), 'file')
+        self.sync()
+    
+    def test_mode_change(self):
+        write(os.path.join(self.old, 'script'), 'script')
+        write(os.path.join(self.new, 'script'), 'script')
+        os.chmod(os.path.join(self.new, 'script'), 0o755)
+        self.sync()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+'''Caches prepared test fixtures between test runs.
+
+Preparing a fixture typically runs many git commands. The resulting
+directory is stored as a snapshot keyed on a hash of the preparation
+script, the fixture path and the git version, and later runs restore
+the snapshot with a plain copy instead of preparing the fixture again.
+
+Set TESTS_NO_FIXTURE_CACHE=1 to always prepare fixtures from scratch.
+'''
+
+import hashlib
+import os
+import os.path
+
+from buildploy import run, rm_rf, output_to_string
+
+# bump when the way fixtures are prepared changes
+cache_version = '1'
+
+git_version = None
+
+def fixture_key(fixture_dir, script):
+    global git_version
+    if git_version is None:
+        git_version = output_to_string(run(['git', '--version'], return_stdout=True))
+    key = "\n".join([cache_version, git_version, os.path.realpath(fixture_dir), script])
+    return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+def prepare_cached(fixture_dir, script, cache_dir, prepare):
+    '''Recreates fixture_dir, either by calling prepare, which should
+    populate the empty fixture_dir by running script, or by copying
+    a snapshot made after a previous call with the same script.
+    
+    Returns True if the fixture was restored from the cache.
+    '''
+    
+    rm_rf(fixture_dir)
+    if os.environ.get('TESTS_NO_FIXTURE_CACHE'):
+        os.mkdir(fixture_dir)
+        prepare()
+        return False
+    
+    snapshot = os.path.join(cache_dir, fixture_key(fixture_dir, script))
+    if os.path.exists(snapshot):
+        run(['cp', '-a', snapshot, fixture_dir])
+        return True
+    
+    os.mkdir(fixture_dir)
+    prepare()
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # created by a concurrently running spec
+            pass
+    # snapshots appear atomically, as specs may run in parallel
+    tmp = '%s.tmp-%d' % (snapshot, os.getpid())
+    rm_rf(tmp)
+    run(['cp', '-a', fixture_dir, tmp])
+    try:
+        os.rename(tmp, snapshot)
+    except OSError:
+        rm_rf(tmp)
+    return False
@@ -2,33 +2,37 @@ import os
 import os.path
 import buildploy
 import unittest
-import shutil
+from tests.fixture_cache import prepare_cached
 
 run_in_dir = buildploy.run_in_dir
 
+fixture_script = '''
+    git init upstream &&
+    cd upstream &&
+    touch a &&
+    git add . &&
+    git commit -m a &&
+    git branch a &&
+    touch b &&
+    git add . &&
+    git commit -m b &&
+    git branch b &&
+    cd .. &&
+    git clone upstream cloned
+'''
+
+class Config(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
 class GitTest(unittest.TestCase):
     def setUp(self):
         super(GitTest, self).setUp()
         
         test_tmp = os.environ.get('TESTS_TMP') or os.path.join(os.path.dirname(__file__), 'tmp')
         self.test_dir = os.path.join(test_tmp, 'unit')
-        if os.path.exists(self.test_dir):
-            shutil.rmtree(self.test_dir)
-        os.mkdir(self.test_dir)
-        run_in_dir(self.test_dir, '''
-            git init upstream &&
-            cd upstream &&
-            touch a &&
-            git add . &&
-            git commit -m a &&
-            git branch a &&
-            touch b &&
-            git add . &&
-            git commit -m b &&
-            git branch b &&
-            cd .. &&
-            git clone upstream cloned
-        ''', shell=True)
+        prepare_cached(self.test_dir, fixture_script, os.path.join(test_tmp, '.fixture-cache'),
+            lambda: run_in_dir(self.test_dir, fixture_script, shell=True))
     
     def test_git_list_local_branches(self):
         branches = buildploy.git_list_local_branches(os.path.join(self.test_dir, 'upstream'))
@@ -37,6 +41,51 @@ class GitTest(unittest.TestCase):
     def test_git_list_remote_branches(self):
         branches = buildploy.git_list_remote_branches(os.path.join(self.test_dir, 'cloned'))
         assert 'origin/a' in branches
+    
+    def test_ref_store(self):
+        refs = buildploy.RefStore(os.path.join(self.test_dir, 'cloned'))
+        assert 'master' in refs.local_branches()
+        assert 'origin/b' in refs.remote_branches()
+        self.assertEqual('b\n', refs.message('refs/remotes/origin/b'))
+        assert refs.tree('refs/remotes/origin/a') != refs.tree('refs/remotes/origin/b')
+        assert not refs.exists('refs/heads/missing')
+        refs.set('refs/heads/missing')
+        assert 'missing' in refs.local_branches()
+    
+    def test_git_rev_parse(self):
+        upstream = os.path.join(self.test_dir, 'upstream')
+        ids = buildploy.git_rev_parse(upstream, ['a', 'b', 'a', 'a^{tree}'])
+        self.assertEqual(4, len(ids))
+        self.assertNotEqual(ids[0], ids[1])
+        self.assertEqual(ids[0], ids[2])
+        self.assertNotEqual(ids[0], ids[3])
+    
+    def test_commit_build_with_plumbing(self):
+        cloned = os.path.join(self.test_dir, 'cloned')
+        build_dir = os.path.join(self.test_dir, 'build')
+        os.mkdir(build_dir)
+        with open(os.path.join(build_dir, 'built'), 'w') as f:
+            f.write('built\n')
+        merged_config = Config(deploy_subdir=None,
+            discard_deploy_history=False, deploy_engine='plumbing',
+            keep_last=None, keep_days=None, artifact_store=None)
+        deploy_refs = buildploy.RefStore(cloned)
+        buildploy.commit_build(cloned, build_dir, 'deployed', 'Built',
+            merged_config, deploy_refs)
+        assert 'deployed' in deploy_refs.local_branches()
+        
+        files = buildploy.git_in_dir(cloned,
+            ['ls-tree', '--name-only', 'deployed'], return_stdout=True)
+        self.assertEqual('built', buildploy.output_to_string(files).strip())
+        ids = buildploy.git_rev_parse(cloned, ['deployed^', 'master'])
+        self.assertEqual(ids[1], ids[0])
+        # the work tree of the deployment repository is not touched
+        assert not os.path.exists(os.path.join(cloned, 'built'))
+    
+    def test_push_command_forces_rewritten_branches(self):
+        merged_config = Config(discard_deploy_history=False)
+        self.assertEqual(['push', 'deploy', 'a', '+b'],
+            buildploy.push_command(['a', 'b'], merged_config, set(['b'])))
 
 if __name__ == '__main__':
     unittest.main()
@@ -6,10 +6,15 @@ import yaml
 import os
 import os.path
 import subprocess
+import optparse
+import multiprocessing
+import time
+import traceback
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from buildploy import run, run_in_dir, git_in_dir, rm_rf
+from buildploy import run, run_in_dir, git_in_dir
+from tests.fixture_cache import prepare_cached
 
 def discover_tests(test_specs_dir):
     tests = []
@@ -23,6 +28,12 @@ test_root = os.path.dirname(__file__)
 test_root = os.path.realpath(test_root)
 test_specs_dir = os.path.join(test_root, 'specs')
 test_tmp = os.environ.get('TESTS_TMP') or os.path.join(test_root, 'tmp')
+build_script = os.path.join(test_root, '../buildploy.py')
+fixture_cache_dir = os.path.join(test_tmp, '.fixture-cache')
+# lets check scripts invoke buildploy again
+os.environ['BUILDPLOY'] = build_script
+# keeps buildploy's configuration cache out of the home directory
+os.environ['XDG_CACHE_HOME'] = os.path.join(test_tmp, '.cache')
 
 def remove_extension(basename):
     if '.' in basename:
@@ -40,21 +51,40 @@ def find_files_under(start_path):
     relative_paths.sort()
     return relative_paths
 
-def run_spec(test):
-    print('Running %s' % test)
+def run_spec(test, log=None):
+    '''Runs the specified spec.
+    
+    If log is given, messages and output of commands run by the spec
+    are written to it rather than to standard output.
+    '''
+    
+    def say(msg):
+        if log is None:
+            print(msg)
+        else:
+            log.write(msg + "\n")
+            log.flush()
+    
+    if log is None:
+        output_kwargs = {}
+    else:
+        output_kwargs = dict(stdout=log, stderr=subprocess.STDOUT)
+    
+    say('Running %s' % test)
     
     spec_path = os.path.join(test_specs_dir, test)
     with open(spec_path) as f:
-        spec = yaml.load(f)
+        spec = yaml.safe_load(f)
     
     test_dir = os.path.join(test_tmp, remove_extension(test))
     
-    print('==> Preparing %s' % test)
-    rm_rf(test_dir)
-    os.mkdir(test_dir)
-    run_in_dir(test_dir, spec['prepare'], shell=True)
+    say('==> Preparing %s' % test)
+    prepare = spec['prepare'] or ''
+    def run_prepare():
+        run_in_dir(test_dir, prepare, shell=True, **output_kwargs)
+    if prepare_cached(test_dir, prepare, fixture_cache_dir, run_prepare):
+        say('==> Restored %s from fixture cache' % test)
     
-    build_script = os.path.join(test_root, '../buildploy.py')
     build_output_path = os.path.join(test_dir, 'build_output')
     
     if 'config' in spec:
@@ -71,12 +101,12 @@ def run_spec(test):
     else:
         args = [build_script]
     
-    print('==> Building %s' % test)
+    say('==> Building %s' % test)
     options = []
     for option in spec.get('options') or []:
         options.append(option.replace('{test_dir}', test_dir))
     with open(build_output_path, 'w+') as build_output_f:
-        code = run_in_dir(test_tmp, args + options,
+        code = run_in_dir(test_dir, args + options,
             return_code=True,
             stdout=build_output_f, stderr=subprocess.STDOUT,
             )
@@ -91,20 +121,20 @@ def run_spec(test):
                 msg = 'Build failed'
             build_output_f.seek(0)
             output = build_output_f.read()
-            print(output)
+            say(output)
             assert ok, msg
         
-        print('==> Checking %s' % test)
+        say('==> Checking %s' % test)
         if 'deploy_tree' in spec:
             if 'dir_config' in spec:
                 deploy_repo = spec['dir_config']['deploy_repo']
             else:
                 deploy_repo = spec['config']['deploy_repo']
-            run_in_dir(test_dir, ['git', 'clone', deploy_repo, 'check'])
+            run_in_dir(test_dir, ['git', 'clone', deploy_repo, 'check'], **output_kwargs)
             
             check_dir = os.path.join(test_dir, 'check')
             for branch in spec['deploy_tree']:
-                git_in_dir(check_dir, ['checkout', 'origin/%s' % branch])
+                git_in_dir(check_dir, ['checkout', 'origin/%s' % branch], **output_kwargs)
                 expected_paths = list(spec['deploy_tree'][branch])
                 expected_paths.sort()
                 
@@ -124,15 +154,57 @@ def run_spec(test):
         if 'check' in spec:
             # debugging
             #run_in_dir(test_dir, ['sh', '-cx', spec['check']])
-            run_in_dir(test_dir, spec['check'], shell=True)
+            run_in_dir(test_dir, spec['check'], shell=True, **output_kwargs)
         
         if 'check_output' in spec:
             build_output_f.seek(0)
-            run_in_dir(test_dir, spec['check_output'], shell=True, stdin=build_output_f)
+            run_in_dir(test_dir, spec['check_output'], shell=True, stdin=build_output_f,
+                **output_kwargs)
+
+def run_spec_in_worker(test):
+    '''Runs a spec in a worker process, collecting its output.
+    
+    Returns the spec name, whether it passed, its output and how long
+    it took.
+    '''
+    
+    # temporary files of the spec's commands are isolated per worker
+    worker_tmp = os.path.join(test_tmp, '.worker-%d' % os.getpid())
+    if not os.path.exists(worker_tmp):
+        os.mkdir(worker_tmp)
+    os.environ['TMPDIR'] = worker_tmp
+    
+    log_path = os.path.join(test_tmp, '%s.log' % remove_extension(test))
+    start = time.time()
+    with open(log_path, 'w+') as log:
+        try:
+            run_spec(test, log)
+            ok = True
+        except Exception:
+            log.write(traceback.format_exc())
+            ok = False
+        log.seek(0)
+        output = log.read()
+    return test, ok, output, time.time() - start
+
+def print_slowest(durations, count=5):
+    print('Slowest specs:')
+    slowest = sorted(durations.items(), key=lambda item: item[1], reverse=True)
+    for test, duration in slowest[:count]:
+        print('  %7.2fs %s' % (duration, test))
+
+parser = optparse.OptionParser(usage='Usage: run-tests.py [-j N] [spec ...]')
+parser.add_option('-j', '--jobs', type='int', default=1, dest='jobs',
+    help='Run this many specs in parallel')
+parser.add_option('--no-fixture-cache', action='store_true', dest='no_fixture_cache',
+    help='Prepare spec fixtures from scratch rather than from cached snapshots')
+cmd_options, cmd_args = parser.parse_args()
+if cmd_options.no_fixture_cache:
+    os.environ['TESTS_NO_FIXTURE_CACHE'] = '1'
 
 tests = discover_tests(test_specs_dir)
-if len(sys.argv) > 1:
-    requested_tests = sys.argv[1:]
+if cmd_args:
+    requested_tests = cmd_args
     found_tests = []
     for test in requested_tests:
         test = os.path.basename(test)
@@ -148,7 +220,29 @@ if not os.path.exists(test_tmp):
 
 run('nosetests')
 
-for test in tests:
-    run_spec(test)
+durations = {}
+if cmd_options.jobs > 1:
+    failed = []
+    pool = multiprocessing.Pool(cmd_options.jobs)
+    for test, ok, output, duration in pool.imap_unordered(run_spec_in_worker, tests):
+        durations[test] = duration
+        if ok:
+            print('%s ok (%.2fs)' % (test, duration))
+        else:
+            print('%s FAILED (%.2fs)' % (test, duration))
+            print(output)
+            failed.append(test)
+    pool.close()
+    pool.join()
+    print_slowest(durations)
+    if failed:
+        print('Failed: %s' % ', '.join(sorted(failed)))
+        exit(1)
+else:
+    for test in tests:
+        start = time.time()
+        run_spec(test)
+        durations[test] = time.time() - start
+    print_slowest(durations)
 
 print('Success.')
@@ -0,0 +1,101 @@
+import os
+import os.path
+import subprocess
+import sys
+import threading
+import time
+import buildploy
+import unittest
+
+class RunTest(unittest.TestCase):
+    def test_return_stdout(self):
+        output = buildploy.run(['echo', 'hello'], return_stdout=True)
+        self.assertEqual('hello\n', buildploy.output_to_string(output))
+    
+    def test_return_stdout_failure(self):
+        try:
+            buildploy.run(['sh', '-c', 'exit 3'], return_stdout=True)
+        except subprocess.CalledProcessError as exc:
+            self.assertEqual(3, exc.returncode)
+        else:
+            self.fail('CalledProcessError not raised')
+    
+    def test_return_code(self):
+        self.assertEqual(3, buildploy.run(['sh', '-c', 'exit 3'], return_code=True))
+    
+    def test_output(self):
+        test_tmp = os.environ.get('TESTS_TMP') or os.path.join(os.path.dirname(__file__), 'tmp')
+        log_path = os.path.join(test_tmp, 'run', 'command.log')
+        buildploy.rm_f(log_path)
+        output = buildploy.CommandOutput(log_path=log_path, tail_lines=2)
+        try:
+            buildploy.run('echo one; echo two >&2; echo three; exit 1', shell=True, output=output)
+        except subprocess.CalledProcessError as exc:
+            self.assertEqual(b'two\nthree\n', exc.output)
+        else:
+            self.fail('CalledProcessError not raised')
+        output.close()
+        with open(log_path) as f:
+            self.assertEqual('one\ntwo\nthree\n', f.read())
+    
+    def test_output_not_utf8(self):
+        output = buildploy.CommandOutput()
+        buildploy.run(['printf', 'caf\\351\\n'], output=output)
+        self.assertEqual(b'caf\xe9\n', output.tail())
+    
+    def test_output_long_line(self):
+        output = buildploy.CommandOutput(tail_lines=2)
+        buildploy.run('%s -c "import sys; sys.stdout.write(\'x\' * 200000)"' % sys.executable,
+            shell=True, output=output)
+        # only the last pieces of the line are kept
+        self.assertEqual(65536 + 200000 % 65536, len(output.tail()))
+    
+    def test_timeout(self):
+        start = time.time()
+        # the sleep is started by the shell and must be killed with it
+        self.assertRaises(buildploy.CommandTimeout, buildploy.run,
+            'sleep 10; true', shell=True, timeout=0.5)
+        assert time.time() - start < 5
+    
+    def test_command_timeout_per_thread(self):
+        class Config(object):
+            command_timeout = 0.5
+        
+        results = []
+        def deploy():
+            buildploy.use_command_timeout(Config)
+            try:
+                buildploy.run('sleep 10; true', shell=True)
+            except buildploy.CommandTimeout:
+                results.append('timed out')
+        
+        thread = threading.Thread(target=deploy)
+        thread.start()
+        thread.join()
+        self.assertEqual(['timed out'], results)
+        # other threads keep their own default
+        self.assertEqual(0, buildploy.run(['true'], return_code=True))
+        self.assertEqual(None, getattr(buildploy.command_defaults, 'timeout', None))
+    
+    def test_resource_usage(self):
+        with buildploy.timings.phase('run_test'):
+            # the python process is started by the shell and waited for by it
+            buildploy.run('%s -c "x = bytearray(50 * 1024 * 1024)"' % sys.executable, shell=True)
+        total = buildploy.timings.report()['totals']['run_test']
+        assert total['cpu_seconds'] > 0
+        assert total['max_rss'] >= 50 * 1024 * 1024
+    
+    def test_limits(self):
+        class Config(object):
+            max_memory = 20 * 1024 * 1024
+            cpu_time = None
+            nice = 5
+        
+        cmd = buildploy.limited_command('%s -c "x = bytearray(50 * 1024 * 1024)"' % sys.executable, Config)
+        self.assertNotEqual(0, buildploy.run(cmd, return_code=True))
+        cmd = buildploy.limited_command('nice', Config)
+        niceness = buildploy.output_to_string(buildploy.run(cmd, return_stdout=True)).strip()
+        self.assertEqual(min(os.nice(0) + 5, 19), int(niceness))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import buildploy
+import threading
+import time
+import unittest
+
+class SchedulerTest(unittest.TestCase):
+    def run_jobs(self, scheduler, jobs):
+        '''Queues jobs, given as (project, priority) tuples, while the
+        only build slot is taken, and returns the order they ran in.
+        '''
+        
+        order = []
+        
+        def job(project, priority):
+            with scheduler.slot('build', project, priority):
+                order.append(project)
+        
+        threads = []
+        with scheduler.slot('build', 'blocker', 0):
+            for project, priority in jobs:
+                thread = threading.Thread(target=job, args=(project, priority))
+                thread.start()
+                threads.append(thread)
+                # jobs are queued in a known order
+                while len(scheduler.waiting) < len(threads):
+                    time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        return order
+    
+    def test_priority(self):
+        scheduler = buildploy.Scheduler({'build': 1})
+        order = self.run_jobs(scheduler, [('low', 0), ('high', 10), ('low2', 0)])
+        self.assertEqual(['high', 'low', 'low2'], order)
+    
+    def test_fair_queuing(self):
+        scheduler = buildploy.Scheduler({'build': 2})
+        order = []
+        release = threading.Event()
+        
+        def job(project):
+            with scheduler.slot('build', project, 0):
+                order.append(project)
+                if project == 'busy':
+                    release.wait()
+        
+        # busy holds one slot; of the waiting jobs, the one of the project
+        # without running jobs goes first even though it was queued last
+        busy = threading.Thread(target=job, args=('busy',))
+        busy.start()
+        while not order:
+            time.sleep(0.01)
+        threads = []
+        with scheduler.slot('build', 'blocker', 0):
+            for project in ['busy', 'idle']:
+                thread = threading.Thread(target=job, args=(project,))
+                thread.start()
+                threads.append(thread)
+                while len(scheduler.waiting) < len(threads):
+                    time.sleep(0.01)
+        while len(order) < 2:
+            time.sleep(0.01)
+        self.assertEqual(['busy', 'idle'], order[:2])
+        release.set()
+        for thread in threads + [busy]:
+            thread.join()
+
+if __name__ == '__main__':
+    unittest.main()
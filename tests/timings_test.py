@@ -0,0 +1,28 @@
+import buildploy
+import unittest
+
+class TimingsTest(unittest.TestCase):
+    def test_phases(self):
+        timings = buildploy.Timings()
+        with timings.phase('build', 'master'):
+            timings.add('subprocesses', 1)
+            timings.add('bytes', 10)
+        with timings.phase('build', 'staging'):
+            timings.add('subprocesses', 2)
+        timings.add('subprocesses', 1)
+        
+        report = timings.report()
+        self.assertEqual(4, report['subprocesses'])
+        self.assertEqual(10, report['bytes'])
+        self.assertEqual(3, report['totals']['build']['subprocesses'])
+        self.assertEqual(1, report['totals']['other']['subprocesses'])
+        phases = [(record['branch'], record['phase']) for record in report['phases']]
+        self.assertEqual([('master', 'build'), ('staging', 'build'), (None, 'other')], phases)
+        assert 'master' in timings.summary()
+    
+    def test_format_bytes(self):
+        self.assertEqual('10 B', buildploy.format_bytes(10))
+        self.assertEqual('1.5 KB', buildploy.format_bytes(1536))
+
+if __name__ == '__main__':
+    unittest.main()